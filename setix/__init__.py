@@ -1,16 +1,55 @@
-import numbers
+# similarity measures as functions of:
+# i - number of common symbols, a - size of the query set, b - size of the indexed set
+# They work on numbers and, without importing numpy here, on numpy arrays `i` and `b` with a float `a`.
+# Each measure comes with a function returning the (min, max) range of indexed set sizes which can possibly
+# reach the threshold `t` for a query of size `a`, None meaning unbounded, used to prune candidates before counting.
+_MEASURES = {
+    "jaccard":           (lambda i, a, b: i * 1.0 / (a + b - i),
+                          lambda a, t: (a * t, a / t)),
+    "dice":              (lambda i, a, b: 2.0 * i / (a + b),
+                          lambda a, t: (a * t / (2.0 - t), a * (2.0 - t) / t)),
+    "cosine":            (lambda i, a, b: i / ((a * b) ** 0.5),
+                          lambda a, t: (a * t * t, a / (t * t))),
+    "overlap":           (lambda i, a, b: 2.0 * i / (a + b - abs (a - b)),  # i / min (a, b)
+                          lambda a, t: (None, None)),
+    "query_containment": (lambda i, a, b: i * 1.0 / a,
+                          lambda a, t: (a * t, None)),
+    "set_containment":   (lambda i, a, b: i * 1.0 / b,
+                          lambda a, t: (None, a / t)),
+}
 
-def similarity (set1, set2):
+MEASURES = tuple (sorted (_MEASURES))
+
+def similarity (set1, set2, measure="jaccard"):
     """
     Similarity function used.
-    Input: two arbitrary python sets.
+    Input: two arbitrary python sets, the first one being treated as the query.
     Output: floating point measure of similarity between 0.0 and 1.0.
+    
+    See `SetIntersectionIndexBase.find_similar` for the available measures.
     """
     
+    try:
+        fn = _MEASURES[measure][0]
+    except KeyError:
+        raise ValueError ("measure")
+    
     i = len (set1 & set2)
-    return i * 1.0 / (len (set1) + len (set2) - i)
+    return fn (i, len (set1), len (set2))
 
 class SearchResults (object):
+    # fraction of the postings relevant to the query that were processed before a limit was reached
+    processed = 1.0
+    
+    @property
+    def partial (self):
+        """
+        True if the search was stopped early by a `max_candidates` or `deadline` limit, in which case results may be
+        missing, or have lower scores than they would otherwise. See also `processed`.
+        """
+        
+        return self.processed < 1.0
+    
     def get (self, max_results=None):
         """
         Get an iterator for found results.
@@ -23,6 +62,29 @@ class SearchResults (object):
         
         raise NotImplementedError ()
     
+    def arrays (self, max_results=None):
+        """
+        Get found results as arrays, without touching payloads.
+        Returns: a (set ids, scores) tuple of numpy arrays, ordered by descending score.
+        
+        Set ids can be turned into payloads with the index's .get_payloads() method.
+        
+        Keyword arguments:
+        
+        max_results
+            Max number of results to return.
+        """
+        
+        raise NotImplementedError ()
+    
+    def page (self, offset, limit):
+        """
+        Get a list of at most `limit` found results, skipping the `offset` best ones.
+        Ordering work done for earlier pages is reused.
+        """
+        
+        return self.get_list (offset + limit)[offset:offset + limit]
+    
     def get_list (self, max_results=None):
         """
         Get a list of found results. The list is cached between calls.
@@ -48,12 +110,25 @@ class SearchResults (object):
         return self.get ()
 
 class EmptySearchResults (SearchResults):
+    def __init__ (self, processed=1.0, sid_dtype="uint64", score_dtype="float64"):
+        # dtypes of the (empty) arrays returned by .arrays(), which backends set to those of their non-empty results
+        self.processed = processed
+        self._sid_dtype = sid_dtype
+        self._score_dtype = score_dtype
+    
     def get (self, max_results=None):
         return ()
     
     def get_list (self, max_results=None):
         return []
     
+    def arrays (self, max_results=None):
+        import numpy
+        return numpy.empty (0, dtype=self._sid_dtype), numpy.empty (0, dtype=self._score_dtype)
+    
+    def page (self, offset, limit):
+        return []
+    
     def __len__ (self):
         return 0
 
@@ -131,6 +206,79 @@ class SetIntersectionIndexBase (object):
         
         raise NotImplementedError
     
+    def memory_usage (self):
+        """
+        Estimate memory used by the index.
+        Returns: a dictionary mapping names of components of the index to their sizes in bytes, with the sum under
+        "total". The components depend on the backend, the numpy backend reports:
+        
+        postings_used, postings_slack
+            Bytes used by, and allocated in advance for, the per-symbol lists of sets containing the symbol.
+        symbol_table
+            The symbols, their ids and bookkeeping of the per-symbol lists.
+        signatures
+            Keys identifying unique sets.
+        payload_lists
+            Per-set lists holding payloads. The payloads themselves are not counted.
+        set_sizes, symbol_counts
+            Side arrays supporting .find_similar() and .most_frequent().
+        filters
+            Boolean arrays of filters registered by .register_filter().
+        """
+        
+        raise NotImplementedError
+    
+    def reserve (self, sets=None, symbols=None, postings=None):
+        """
+        Allocate room in advance, so that a bulk load with known cardinalities doesn't need to repeatedly grow
+        (copy) the index's arrays.
+        
+        Keyword arguments:
+        
+        sets
+            Total number of unique sets to make room for.
+        
+        symbols
+            Total number of unique symbols to make room for.
+        
+        postings
+            Either the number of sets containing each symbol already in the index to make room for,
+            or a dictionary mapping symbols, possibly not yet added, to such numbers.
+        """
+        
+        raise NotImplementedError
+    
+    def get_payloads (self, sid):
+        """
+        Get a list of payloads stored for the set with the given id.
+        """
+        
+        raise NotImplementedError
+    
+    def register_filter (self, name, sets):
+        """
+        Register a named filter, restricting the sets searched by queries passing `filter=name`.
+        Registering a filter under an existing name replaces it.
+        
+        Arguments:
+        
+        name
+            A string naming the filter, eg. a tenant or a category.
+        
+        sets
+            Either a boolean array or list indexed by set id, or an iterable of set ids (as returned by `add`).
+            Sets added later, beyond the length of a boolean array, are excluded.
+        """
+        
+        raise NotImplementedError
+    
+    def unregister_filter (self, name):
+        """
+        Remove a named filter registered by `register_filter`.
+        """
+        
+        raise NotImplementedError
+    
     def add (self, iterable, payload=_SENTINEL):
         """
         Index a set of symbols.
@@ -146,34 +294,125 @@ class SetIntersectionIndexBase (object):
         payload
             Any object to store alongside the set. If omitted, the iterable itself is stored.
             Payloads don't need to be hashable.
+        
+        Returns: the id of the set, which is the same for all equal sets.
         """
         
         raise NotImplementedError
     
-    def find (self, iterable, threshold=1, max_results=None):
+    def add_many (self, items):
+        """
+        Index many sets at once, possibly faster than by calling `add` for each of them.
+        
+        Arguments:
+        
+        items
+            An iterable of (iterable, payload) pairs, see `add`.
+        """
+        
+        for iterable, payload in items:
+            self.add (iterable, payload)
+    
+    def find (self, iterable, threshold=1, max_results=None, filter=None, max_candidates=None, deadline=None):
         """
         Find sets in the index with at least `threshold` intersections with the given `iterable`.
         Returns: a SearchResults iterable returning (number of intersections, [list of payloads]) tuples.
         
         If threshold is negative, the number of unique symbols in `iterable` is added to it.
+        
+        Keyword arguments:
+        
+        filter (default: None)
+            Restricts the search to some sets: either the name of a filter registered by `register_filter`,
+            or a boolean array or set ids, as accepted by `register_filter`. Sets are filtered out before counting
+            intersections, so a filtered query is cheaper than an unfiltered one.
+        
+        max_candidates (default: None)
+            Max number of postings (set occurrences in the lists of sets containing each symbol) to process,
+            which also bounds the number of candidate sets.
+        
+        deadline (default: None)
+            Time, as returned by time.time(), after which no further postings are processed.
+        
+        Posting lists are processed rarest symbols first. When a limit is reached, best-effort results are returned,
+        counting only the symbols processed so far, with their `partial` attribute set (see `SearchResults`).
         """
         
         raise NotImplementedError
     
-    def find_similar (self, iterable, threshold=0.3):
+    def find_similar (self, iterable, threshold=0.3, measure="jaccard", filter=None, max_candidates=None, deadline=None):
         """
         Find sets in the index with at least `threshold` similarity score to the given `iterable`.
         Returns: a SearchResults iterable returning (similarity, [list of payloads]) tuples.
+        Only sets passing `filter` are searched, within the `max_candidates` and `deadline` limits, see `find`.
         
-        The similarity score is computed as:
+        The similarity score depends on `measure`, where
+        `i` is the number of common symbols to both sets,
+        `A` is the size of the query set and `B` the size of the indexed set:
+        
+        "jaccard" (default)
                 i
             ---------
             A + B - i
-        where
-        `i` is the number of common symbols to both sets,
-        `A` and `B` are sizes of the two sets.
+            (This scoring function was borrowed from the PostgreSQL extension pg_trgm.)
         
-        (This scoring function was borrowed from the PostgreSQL extension pg_trgm.)
+        "dice"
+              2i
+            -----
+            A + B
+        
+        "cosine"
+                i
+            ---------
+            sqrt(A*B)
+        
+        "overlap"
+                i
+            ---------
+            min(A, B)
+        
+        "query_containment"
+            i / A  (how much of the query is contained in the indexed set)
+        
+        "set_containment"
+            i / B  (how much of the indexed set is contained in the query)
+        """
+        
+        raise NotImplementedError
+    
+    def find_many (self, iterables, threshold=1, filter=None):
+        """
+        Perform `find` for each of the given `iterables`, possibly in a single vectorized pass.
+        Returns: a list of SearchResults, one per query.
+        """
+        
+        return [self.find (iterable, threshold, filter=filter) for iterable in iterables]
+    
+    def find_similar_many (self, iterables, threshold=0.3, measure="jaccard", filter=None):
+        """
+        Perform `find_similar` for each of the given `iterables`, possibly in a single vectorized pass.
+        Returns: a list of SearchResults, one per query.
+        """
+        
+        return [self.find_similar (iterable, threshold, measure, filter) for iterable in iterables]
+    
+    def similarity_join (self, threshold, other=None, measure="jaccard", chunk_size=2**20):
+        """
+        Find all pairs of sets with at least `threshold` similarity score, either within this index,
+        or between this index and `other`.
+        Returns: an iterator over (set ids, set ids of the other index, similarity scores) tuples of numpy arrays.
+        Within one index each pair is returned once, with the lower set id first.
+        
+        Keyword arguments:
+        
+        other
+            Another index of the same kind, None (the default) means this index.
+        
+        measure (default: "jaccard")
+            One of "jaccard", "dice" and "cosine", see `find_similar`.
+        
+        chunk_size (default: 2**20)
+            Approximate max number of candidate pairs evaluated at once, which bounds memory use.
         """
         
         raise NotImplementedError
@@ -196,14 +435,10 @@ class SetIntersectionIndexBase (object):
         
         raise NotImplementedError
 
-try:
-    import importlib
-except ImportError:
-    def import_backend (name):
-        return __import__ ("setix.backends.b_" + name)
-else:
-    def import_backend (name):
-        return importlib.import_module (".backends.b_" + name, __name__)
+def import_backend (name):
+    # a non-empty fromlist makes __import__ return the submodule itself,
+    # without paying for importing importlib
+    return __import__ (__name__ + ".backends.b_" + name, fromlist=["SetIntersectionIndex"])
 
 _BACKENDS = {}
 
@@ -212,15 +447,19 @@ def SetIntersectionIndex (backend="numpy",
                           max_symbols=2**16,
                           init_bucket_size=16,
                           support_most_frequent=True,
-                          support_find_similar=True):
+                          support_find_similar=True,
+                          growth_factor=1.25,
+                          **kwargs):
         """
         Create a new index for finding intersecting sets.
         
         Keyword arguments:
         
         backend (default: "numpy")
-            Specific implementation of a set intersection index to use.
-            Currently only "numpy" is supported.
+            Specific implementation of a set intersection index to use:
+            "numpy" - exact results,
+            "minhash" - approximate results using MinHash signatures in banded LSH tables, for very large corpora
+                        (see setix.backends.b_minhash for its additional arguments).
         
         max_sets (default: 2**32, min: 1, max: 2**64)
             Maximum number of sets that this index should be able to handle, note that this doesn't mean unique sets,
@@ -243,11 +482,21 @@ def SetIntersectionIndex (backend="numpy",
         support_find_similar (default: True)
             Boolean indicating whether the size of each added set should be remembered, for calculating normalized
             similarities between sets by the .find_similar() method.
+        
+        growth_factor (default: 1.25, min: > 1)
+            Factor by which arrays are enlarged when they run out of room. See also the .reserve() method.
+        
+        Other keyword arguments are passed to the backend.
         """
         
-        module = _BACKENDS[backend] = _BACKENDS.get (backend, False) or import_backend (backend)
+        module = _BACKENDS.get (backend)
+        if module is None:
+            module = _BACKENDS[backend] = import_backend (backend)
+        
         return module.SetIntersectionIndex (max_sets=max_sets,
                                             max_symbols=max_symbols,
                                             init_bucket_size=init_bucket_size,
                                             support_most_frequent=support_most_frequent,
-                                            support_find_similar=support_find_similar)
+                                            support_find_similar=support_find_similar,
+                                            growth_factor=growth_factor,
+                                            **kwargs)
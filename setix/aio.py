@@ -0,0 +1,275 @@
+"""
+asyncio facade for set intersection and trigram indexes.
+
+Queries are evaluated on a bounded thread pool, so they don't block the event loop. Most of the work done by a query
+happens inside numpy (concatenate, unique, bincount), which releases the GIL, so several queries can make progress
+in parallel.
+
+Requires Python 3.5 or newer.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+
+class QueueFull (RuntimeError):
+    """
+    Raised when a query is submitted while `max_pending` queries are already waiting for results.
+    """
+
+class _Job (object):
+    __slots__ = ("future", "waiters")
+    
+    def __init__ (self, future):
+        self.future = future
+        self.waiters = 0
+
+class AsyncIndex (object):
+    """
+    Wraps a set intersection index (or a TrigramIndex) for use from asyncio code.
+    
+    Only queries go through this wrapper. Mutating the wrapped `index` while queries are in flight is not supported.
+    
+    A `deadline` passed to `find` or `find_similar` also covers the time a query waits for a free worker, so a query
+    whose deadline passes in the queue returns partial results (usually none) right away. Queries with limits
+    are not batched.
+    """
+    
+    # methods whose calls can be evaluated together by their "_many" variants
+    _BATCHABLE = {"find": ("threshold", "filter"),
+                  "find_similar": ("threshold", "measure", "filter")}
+    
+    def __init__ (self, index, max_workers=4, max_pending=1024, coalesce=True,
+                  batch=False, max_batch=64, batch_delay=0.0, executor=None):
+        """
+        Arguments:
+        
+        index
+            The index to query, either a SetIntersectionIndexBase-derived object or a TrigramIndex.
+        
+        Keyword arguments:
+        
+        max_workers (default: 4)
+            Max number of queries (or query batches) evaluated at the same time.
+        
+        max_pending (default: 1024)
+            Max number of queries waiting for results, further submissions raise QueueFull.
+            None means unlimited.
+        
+        coalesce (default: True)
+            Boolean indicating whether identical queries submitted while one is in flight should share its result.
+        
+        batch (default: False)
+            Boolean indicating whether concurrent `find` and `find_similar` calls with equal arguments should be
+            evaluated together, in a single vectorized pass, by the index's `find_many` and `find_similar_many`.
+            Calls filtered by arrays, rather than by names of registered filters, are evaluated one by one.
+        
+        max_batch (default: 64)
+            Max number of queries evaluated in one batch.
+        
+        batch_delay (default: 0.0)
+            Time in seconds to wait for more queries before evaluating a batch. With 0, queries submitted in the same
+            event loop iteration are batched.
+        
+        executor (default: a new ThreadPoolExecutor)
+            A concurrent.futures executor to run queries on. It is not shut down by `close`.
+        """
+        
+        if max_workers < 1:
+            raise ValueError ("max_workers")
+        
+        if max_pending is not None and max_pending < 1:
+            raise ValueError ("max_pending")
+        
+        if max_batch < 1:
+            raise ValueError ("max_batch")
+        
+        self.index = index
+        self._max_pending = max_pending
+        self._coalesce = bool (coalesce)
+        self._batch = bool (batch)
+        self._max_batch = max_batch
+        self._batch_delay = batch_delay
+        
+        self._own_executor = executor is None
+        self._executor = executor or concurrent.futures.ThreadPoolExecutor (max_workers)
+        self._slots = None
+        self._max_workers = max_workers
+        
+        self._pending = 0
+        self._inflight = {}
+        self._batches = {}
+    
+    @property
+    def pending (self):
+        """
+        Number of queries waiting for results (identical coalesced queries are counted once).
+        """
+        
+        return self._pending
+    
+    def close (self):
+        """
+        Shut down the thread pool, if it was created by this object.
+        """
+        
+        if self._own_executor:
+            self._executor.shutdown (wait=False)
+    
+    async def find (self, query, threshold=1, filter=None, **kwargs):
+        """
+        Analogous to `SetIntersectionIndexBase.find`
+        """
+        
+        kwargs["threshold"] = threshold
+        kwargs["filter"] = filter
+        return await self._submit ("find", query, kwargs)
+    
+    async def find_similar (self, query, threshold=0.3, measure="jaccard", filter=None, **kwargs):
+        """
+        Analogous to `SetIntersectionIndexBase.find_similar`
+        """
+        
+        kwargs["threshold"] = threshold
+        kwargs["measure"] = measure
+        kwargs["filter"] = filter
+        return await self._submit ("find_similar", query, kwargs)
+    
+    async def _submit (self, method, query, kwargs):
+        if not isinstance (query, str):
+            query = tuple (query)
+        
+        key = self._key (method, query, kwargs) if self._coalesce else None
+        job = self._inflight.get (key) if key is not None else None
+        
+        if job is None:
+            if self._max_pending is not None and self._pending >= self._max_pending:
+                raise QueueFull ("too many pending queries")
+            
+            job = self._start (method, query, kwargs)
+            if key is not None:
+                self._inflight[key] = job
+                job.future.add_done_callback (functools.partial (self._forget, key, job))
+        
+        job.waiters += 1
+        try:
+            return await asyncio.shield (job.future)
+        finally:
+            job.waiters -= 1
+            if job.waiters == 0 and not job.future.done ():
+                # every caller interested in this result was cancelled
+                if key is not None and self._inflight.get (key) is job:
+                    del self._inflight[key]
+                job.future.cancel ()
+    
+    @staticmethod
+    def _key (method, query, kwargs):
+        if not isinstance (query, str):
+            # duplicates matter for scoring, order doesn't
+            query = frozenset (collections.Counter (query).items ())
+        
+        key = (method, query, tuple (sorted (kwargs.items ())))
+        try:
+            hash (key)
+        except TypeError:
+            return None
+        return key
+    
+    def _forget (self, key, job, future):
+        if self._inflight.get (key) is job:
+            del self._inflight[key]
+    
+    def _start (self, method, query, kwargs):
+        loop = asyncio.get_event_loop ()
+        
+        batchable = self._BATCHABLE.get (method)
+        args = None
+        if self._batch and batchable is not None and set (kwargs) == set (batchable):
+            args = tuple (kwargs[k] for k in batchable)
+            try:
+                hash (args)
+            except TypeError:
+                args = None
+        
+        if args is not None:
+            future = loop.create_future ()
+            self._enqueue (loop, method, args, query, future)
+        else:
+            future = asyncio.ensure_future (self._run (functools.partial (getattr (self.index, method), query, **kwargs)))
+        
+        self._pending += 1
+        future.add_done_callback (self._done)
+        return _Job (future)
+    
+    def _done (self, future):
+        self._pending -= 1
+    
+    async def _run (self, fn):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore (self._max_workers)
+        
+        # waiting for a slot here, rather than in the executor's queue, keeps cancellation of queued queries free
+        async with self._slots:
+            return await asyncio.get_event_loop ().run_in_executor (self._executor, fn)
+    
+    def _enqueue (self, loop, method, args, query, future):
+        bkey = (method, args)
+        batch = self._batches.get (bkey)
+        
+        if batch is None:
+            batch = self._batches[bkey] = []
+            if self._batch_delay > 0:
+                loop.call_later (self._batch_delay, self._flush, bkey, batch)
+            else:
+                loop.call_soon (self._flush, bkey, batch)
+        
+        batch.append ((query, future))
+        if len (batch) >= self._max_batch:
+            self._flush (bkey, batch)
+    
+    def _flush (self, bkey, batch):
+        if self._batches.get (bkey) is not batch:
+            return  # already flushed
+        del self._batches[bkey]
+        
+        batch = [(query, future) for query, future in batch if not future.done ()]
+        if not batch:
+            return
+        
+        method, args = bkey
+        fn = functools.partial (getattr (self.index, method + "_many"), [query for query, future in batch], *args)
+        asyncio.ensure_future (self._run_batch (fn, batch))
+    
+    async def _run_batch (self, fn, batch):
+        try:
+            results = await self._run (fn)
+        except Exception as e:
+            for query, future in batch:
+                if not future.done ():
+                    future.set_exception (e)
+        else:
+            for (query, future), result in zip (batch, results):
+                if not future.done ():
+                    future.set_result (result)
+
+class AsyncTrigramIndex (AsyncIndex):
+    """
+    An AsyncIndex wrapping a TrigramIndex.
+    """
+    
+    def __init__ (self, index=None, **kwargs):
+        """
+        Arguments:
+        
+        index (default: a new TrigramIndex)
+            The TrigramIndex to query.
+        
+        Other keyword arguments are passed to AsyncIndex.
+        """
+        
+        if index is None:
+            from .trgm import TrigramIndex
+            index = TrigramIndex ()
+        
+        super (AsyncTrigramIndex, self).__init__ (index, **kwargs)
@@ -0,0 +1,387 @@
+"""
+Approximate set intersection index, storing MinHash signatures of sets in banded LSH tables.
+
+Every set gets a signature of `bands * rows` MinHash values. A set is a candidate for a query when all `rows` values of
+at least one band of its signature are equal to the query's. A set with Jaccard similarity `s` to the query becomes
+a candidate with probability 1 - (1 - s**rows)**bands, so more bands raise recall while more rows make lookups more
+selective. Sets which don't become candidates are missing from search results.
+
+Each band is a table of two numpy arrays: a 64 bit key combining the band's MinHash values per set, and the set ids,
+sorted by key and looked up with `searchsorted`. Sets added since the last sort are kept in an unsorted tail, which is
+scanned by queries and merged into the sorted part once it grows, or at the end of `add_many`.
+
+Candidates are scored exactly when `rescore` is enabled, otherwise intersection counts are estimated from the fraction
+of equal signature values, keeping only the lowest 8 bits of each value.
+"""
+
+import numpy
+import numbers
+import struct
+import time
+
+from .b_numpy import _IndexBase, _grown, _ranges
+
+_MIX = numpy.uint64 (0x9E3779B97F4A7C15)  # odd multiplier combining the values of a band into its key
+
+_COLLISION = 1.0 / 256  # probability of 8 bit signature values of different sets being equal
+
+_MIN_TAIL = 1024  # min number of unsorted band entries before merging them into the sorted part
+
+_SIGN_CHUNK = 2**21  # max number of hash values computed at once by add_many
+
+def _grown_columns (arr, size):
+    # like _grown, for arrays with a row per band
+    new = numpy.zeros (arr.shape[0:1] + (size,), dtype=arr.dtype)
+    new[:, 0:arr.shape[1]] = arr
+    return new
+
+class SetIntersectionIndex (_IndexBase):
+    def __init__ (self,
+                  max_sets=2**32,
+                  max_symbols=2**16,
+                  init_bucket_size=16,
+                  support_most_frequent=True,
+                  support_find_similar=True,
+                  growth_factor=1.25,
+                  bands=16,
+                  rows=4,
+                  rescore=False,
+                  seed=0):
+        """
+        See the factory function `setix.SetIntersectionIndex` for the common arguments.
+        
+        Keyword arguments:
+        
+        bands (default: 16, min: 1)
+            Number of LSH tables, more bands give better recall and slower lookups.
+        
+        rows (default: 4, min: 1)
+            Number of MinHash values per band, more rows give fewer false candidates and worse recall.
+        
+        rescore (default: False)
+            Boolean indicating whether the symbols of each set should be kept, for scoring candidates exactly.
+            Otherwise scores are estimated from signatures. Keeping the symbols takes as much memory as the posting
+            lists of the exact index, on top of the LSH tables.
+        
+        seed (default: 0)
+            Seed for choosing hash functions.
+        """
+        
+        for name, value in (("bands", bands), ("rows", rows)):
+            if not isinstance (value, numbers.Integral):
+                raise TypeError (name)
+            if value < 1:
+                raise ValueError (name)
+        
+        # the symbol table maps symbols to symbol ids
+        _IndexBase.__init__ (self,
+                             max_sets=max_sets,
+                             max_symbols=max_symbols,
+                             init_bucket_size=init_bucket_size,
+                             support_most_frequent=support_most_frequent,
+                             support_find_similar=support_find_similar,
+                             growth_factor=growth_factor)
+        
+        self._bands = bands
+        self._rows = rows
+        self._rescore = bool (rescore)
+        
+        # multiply-shift hash functions, (a * x + b) >> 32 with random 64 bit a (odd) and b
+        random = numpy.random.RandomState (seed)
+        words = random.randint (0, 2**32, size=(4, bands * rows), dtype=numpy.int64).astype (numpy.uint64)
+        self._hash_a = (words[0] << numpy.uint64 (32)) | words[1] | numpy.uint64 (1)
+        self._hash_b = (words[2] << numpy.uint64 (32)) | words[3]
+        
+        # band tables, entries [0:_num_sorted] of each row are sorted by key, [_num_sorted:_num_entries] are not
+        size = self._sets.size
+        self._band_keys = numpy.zeros ((bands, size), dtype=numpy.uint64)
+        self._band_sids = numpy.zeros ((bands, size), dtype=self._dtype_sets)
+        self._num_sorted = 0
+        self._num_entries = 0
+        
+        # set sizes count repeated symbols, like the exact index does
+        self._set_sizes = numpy.zeros (size, dtype=self._dtype_symbols)
+        
+        if self._rescore:
+            # sorted symbol ids of set `sid` are _members[_member_starts[sid]:_member_starts[sid] + _set_sizes[sid]]
+            self._members = numpy.zeros (8 * init_bucket_size, dtype=self._dtype_symbols)
+            self._member_starts = numpy.zeros (size, dtype=numpy.int64)
+            self._num_members = 0
+        else:
+            self._signatures = numpy.zeros ((size, bands * rows), dtype=numpy.uint8)
+    
+    @property
+    def bands (self):
+        return self._bands
+    
+    @property
+    def rows (self):
+        return self._rows
+    
+    def _grow_sets (self, size):
+        if self._sets.size < size:
+            self._sets = _grown (self._sets, size)
+            self._set_sizes = _grown (self._set_sizes, size)
+            self._band_keys = _grown_columns (self._band_keys, size)
+            self._band_sids = _grown_columns (self._band_sids, size)
+            if self._rescore:
+                self._member_starts = _grown (self._member_starts, size)
+            else:
+                self._signatures = _grown (self._signatures, size)
+    
+    def _memory_usage (self):
+        usage = self._table_usage ()
+        
+        usage["set_sizes"] = self._set_sizes.nbytes
+        usage["lsh_tables"] = self._band_keys.nbytes + self._band_sids.nbytes
+        
+        if self._rescore:
+            usage["members"] = self._members.nbytes + self._member_starts.nbytes
+        else:
+            usage["minhash_signatures"] = self._signatures.nbytes
+        
+        return usage
+    
+    def _minhashes (self, members):
+        # MinHash signatures, one row per array of symbol ids in `members`, none of which may be empty
+        lengths = numpy.array ([m.size for m in members], dtype=numpy.int64)
+        x = numpy.concatenate (members).astype (numpy.uint64)[:, None] + 1
+        hashes = (x * self._hash_a + self._hash_b) >> numpy.uint64 (32)
+        return numpy.minimum.reduceat (hashes, numpy.cumsum (lengths) - lengths, axis=0)
+    
+    def _keys (self, minhashes):
+        # band keys, one row per signature and one column per band
+        values = minhashes.reshape (-1, self._bands, self._rows)
+        keys = values[:, :, 0].copy ()
+        for r in range (1, self._rows):
+            keys *= _MIX
+            keys ^= values[:, :, r]
+        return keys
+    
+    def _sign (self, pending):
+        # stores signatures and band keys of the sets in `pending`, a list of (set id, array of symbol ids)
+        if not pending:
+            return
+        
+        sids = numpy.array ([sid for sid, ids in pending], dtype=self._dtype_sets)
+        minhashes = self._minhashes ([ids for sid, ids in pending])
+        
+        if not self._rescore:
+            self._signatures[sids] = minhashes & 0xFF
+        
+        start = self._num_entries
+        end = self._num_entries = start + sids.size
+        self._band_keys[:, start:end] = self._keys (minhashes).T
+        self._band_sids[:, start:end] = sids
+        
+        del pending[:]
+    
+    def _merge (self):
+        # sorts all band entries by key, entries with equal keys stay ordered by set id
+        n = self._num_entries
+        order = numpy.argsort (self._band_keys[:, 0:n], axis=1, kind="mergesort")
+        rows = numpy.arange (self._bands)[:, None]
+        self._band_keys[:, 0:n] = self._band_keys[rows, order]
+        self._band_sids[:, 0:n] = self._band_sids[rows, order]
+        self._num_sorted = n
+    
+    def add_many (self, items):
+        # signatures are computed in bulk, and band tables sorted once at the end
+        pending = []
+        hashes = 0
+        try:
+            for iterable, payload in items:
+                num_pending = len (pending)
+                self._add (iterable, payload, pending)
+                if len (pending) > num_pending:
+                    hashes += pending[-1][1].size * self._bands * self._rows
+                    if hashes > _SIGN_CHUNK:
+                        self._sign (pending)
+                        hashes = 0
+        finally:
+            self._sign (pending)
+            if self._num_sorted < self._num_entries:
+                self._merge ()
+    
+    def _add (self, iterable, payload, pending):
+        max_symbols = self._max_symbols
+        symbols = self._symbols
+        index = self._index
+        
+        ids = []
+        num_syms = len (symbols)
+        
+        for symbol in iterable:
+            id = index.get (symbol)
+            
+            if id is None:
+                # register new symbol
+                
+                id = len (symbols)
+                
+                if id >= max_symbols:
+                    raise RuntimeError ("index full: maximum number of symbols reached")
+                
+                index[symbol] = id
+                symbols.append (symbol)
+            
+            ids.append (id)
+        
+        sig = sorted (set (ids))
+        
+        lsig = len (sig)
+        packer = self._packers[lsig] = self._packers.get(lsig) or struct.Struct(self._struct_symbols * lsig).pack
+        ssig = packer (*sig)
+        
+        sid = self._sets_by_sig.get (ssig)
+        if sid is None:
+            # register new set
+            
+            sid = self._num_sets
+            if sid >= self._max_sets:
+                raise RuntimeError ("index full: maximum number of sets reached")
+            
+            self._num_sets += 1
+            if sid >= self._sets.size:
+                self._grow_sets (self._capacity (self._sets.size, sid + 1))
+            
+            self._sets_by_sig[ssig] = sid
+            self._sets[sid] = []
+            self._set_sizes[sid] = len (ids)
+            
+            if self._rescore:
+                start = self._num_members
+                end = self._num_members = start + len (ids)
+                if end > self._members.size:
+                    self._members = _grown (self._members, self._capacity (self._members.size, end))
+                self._members[start:end] = sorted (ids)
+                self._member_starts[sid] = start
+            
+            if lsig:
+                if pending is not None:
+                    pending.append ((sid, numpy.array (sig, dtype=numpy.uint64)))
+                else:
+                    self._sign ([(sid, numpy.array (sig, dtype=numpy.uint64))])
+                    if self._num_entries - self._num_sorted > max (_MIN_TAIL, self._num_sorted // 16):
+                        self._merge ()
+        
+        if self._support_most_frequent:
+            # update counts of symbol occurrences
+            
+            symbol_counts = self._symbol_counts
+            
+            new_syms = len (symbols)
+            if new_syms > num_syms and new_syms >= symbol_counts.size:
+                self._symbol_counts = symbol_counts = _grown (symbol_counts, self._capacity (symbol_counts.size, new_syms + 1))
+            
+            for id in ids:
+                symbol_counts[id] += 1
+        
+        self._sets[sid].append (payload)
+        return sid
+    
+    def _lookup (self, band, key):
+        # ids of the sets whose band key equals `key`
+        keys = self._band_keys[band]
+        sorted_end = self._num_sorted
+        
+        lo = keys[0:sorted_end].searchsorted (key, "left")
+        hi = keys[0:sorted_end].searchsorted (key, "right")
+        found = self._band_sids[band, lo:hi]
+        
+        tail = numpy.nonzero (keys[sorted_end:self._num_entries] == key)[0]
+        if tail.size:
+            found = numpy.concatenate ((found, self._band_sids[band, sorted_end + tail]))
+        
+        return found
+    
+    def _find (self, iterable, mask=None, max_candidates=None, deadline=None, size_range=None):
+        index = self._index
+        known = {}    # symbol id -> number of occurrences in the query
+        unknown = {}
+        L = 0
+        
+        for symbol in iterable:
+            L += 1
+            id = index.get (symbol)
+            if id is None:
+                # symbols missing from the index can't match, but they still take part in the query's signature
+                if symbol not in unknown:
+                    unknown[symbol] = len (self._symbols) + len (unknown)
+            else:
+                known[id] = known.get (id, 0) + 1
+        
+        if not L or not self._num_entries:
+            return L, [], [], 1.0
+        
+        ids = numpy.array (sorted (known) + sorted (unknown.values ()), dtype=numpy.uint64)
+        minhashes = self._minhashes ([ids])
+        keys = self._keys (minhashes)[0]
+        
+        buckets = []
+        looked_up = self._bands
+        for band in range (self._bands):
+            if deadline is not None and time.time () >= deadline:
+                looked_up = band
+                break
+            bucket = self._lookup (band, keys[band])
+            if bucket.size:
+                buckets.append (bucket)
+        
+        processed = looked_up * 1.0 / self._bands
+        if max_candidates is not None or deadline is not None:
+            # candidates are taken from the smallest bands first, checking limits between bands
+            buckets.sort (key=len)
+            total = sum (bucket.size for bucket in buckets)
+            budget = total if max_candidates is None else min (total, max_candidates)
+            taken = 0
+            
+            for i, bucket in enumerate (buckets):
+                if taken >= budget or (deadline is not None and time.time () >= deadline):
+                    buckets = buckets[0:i]
+                    break
+                if taken + bucket.size > budget:
+                    bucket = buckets[i] = bucket[0:budget - taken]
+                taken += bucket.size
+            
+            if total:
+                processed *= taken * 1.0 / total
+        
+        if not buckets:
+            return L, [], [], processed
+        
+        sids = numpy.unique (numpy.concatenate (buckets))
+        # filtered out candidates, and candidates whose size alone rules them out, are dropped before scoring
+        keep = self._passing (sids, mask, size_range (L) if size_range is not None else None)
+        if keep is not None:
+            sids = sids[keep]
+            if not sids.size:
+                return L, [], [], processed
+        
+        sizes = self._set_sizes[sids].astype (numpy.int64)
+        
+        if self._rescore:
+            # like the exact index, a symbol counts as often as it occurs in the query times in the set
+            query = ids[0:len (known)].astype (self._dtype_symbols)
+            occurrences = numpy.array ([known[id] for id in sorted (known)], dtype=numpy.int64)
+            
+            members = self._members[_ranges (self._member_starts[sids], sizes)]
+            owners = numpy.repeat (numpy.arange (sids.size), sizes)
+            
+            if query.size:
+                at = numpy.minimum (query.searchsorted (members), query.size - 1)
+                hit = query[at] == members
+                counts = numpy.bincount (owners[hit], weights=occurrences[at[hit]], minlength=sids.size).astype (numpy.int64)
+            else:
+                counts = numpy.zeros (sids.size, dtype=numpy.int64)
+        else:
+            # fraction of equal 8 bit values, corrected for collisions, estimates the Jaccard similarity
+            # j = i / (A + B - i)  =>  i = j * (A + B) / (1 + j)
+            equal = (self._signatures[sids] == (minhashes[0] & 0xFF)).mean (axis=1)
+            j = numpy.clip ((equal - _COLLISION) / (1.0 - _COLLISION), 0.0, 1.0)
+            counts = numpy.rint (j * (sizes + L * 1.0) / (1.0 + j)).astype (numpy.int64)
+        
+        return L, sids, counts, processed
+    
+    def _find_many (self, iterables, mask=None, size_range=None):
+        return [self._find (iterable, mask, size_range=size_range) for iterable in iterables]
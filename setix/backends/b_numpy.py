@@ -2,9 +2,20 @@ import numpy
 import numbers
 import math
 import struct
-from six.moves import zip
+import sys
+import time
 
-from .. import SetIntersectionIndexBase, SearchResults, EmptySearchResults
+try:
+    from itertools import izip as zip
+except ImportError:
+    pass
+
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
+from .. import SetIntersectionIndexBase, SearchResults, EmptySearchResults, _MEASURES
 
 def _check_numpy ():
     missing = []
@@ -15,13 +26,54 @@ def _check_numpy ():
         raise ImportError ("setix.backends.numpy: required functions not provided by installed numpy: " + ", ".join(missing))
 _check_numpy ()
 
-class SetIntersectionIndex (SetIntersectionIndexBase):
+# Minimal intersection counts of sets of sizes `a` and `b` reaching the threshold `t`, for measures symmetric in `a` and `b`.
+
+def _jaccard_overlap (a, b, t):
+    return t / (1.0 + t) * (a + b)
+
+def _dice_overlap (a, b, t):
+    return t * (a + b) / 2.0
+
+def _cosine_overlap (a, b, t):
+    return t * numpy.sqrt (a * b)
+
+_MIN_OVERLAPS = {
+    "jaccard": _jaccard_overlap,
+    "dice":    _dice_overlap,
+    "cosine":  _cosine_overlap,
+}
+
+_EPSILON = 1e-9
+
+_CHUNK = 2**16  # min number of postings counted at once by queries with a deadline
+
+_argpartition = getattr (numpy, "argpartition", None)
+
+def _grown (arr, size):
+    # unlike numpy.resize, keeps the shape of rows and fills new space with zeros,
+    # instead of repeating the array's contents
+    new = numpy.zeros ((size,) + arr.shape[1:], dtype=arr.dtype)
+    new[0:arr.shape[0]] = arr
+    return new
+
+def _ranges (starts, counts):
+    # concatenation of the ranges [start, start + count) for all given starts and counts
+    ends = numpy.cumsum (counts)
+    return numpy.arange (ends[-1] if ends.size else 0) - numpy.repeat (ends - counts - starts, counts)
+
+
+class _IndexBase (SetIntersectionIndexBase):
+    # Symbol table, set table, payloads and scoring common to the numpy based backends.
+    # Backends implement adding sets (_add, add_many), counting candidates (_find, _find_many) and _memory_usage,
+    # and decide what the symbol table `_index` maps symbols to.
+    
     def __init__ (self,
                   max_sets=2**32,
                   max_symbols=2**16,
                   init_bucket_size=16,
                   support_most_frequent=True,
-                  support_find_similar=True):
+                  support_find_similar=True,
+                  growth_factor=1.25):
         
         self._sets = numpy.empty (64, dtype="object")
         self._num_sets = 0
@@ -30,6 +82,8 @@ class SetIntersectionIndex (SetIntersectionIndexBase):
         self._index = {}
         self._sets_by_sig = {}
         self._init_bs = init_bucket_size
+        self._growth = growth_factor
+        self._filters = {}
         self._packers = {}
         self._support_most_frequent = bool (support_most_frequent)
         self._support_find_similar = bool (support_find_similar)
@@ -49,9 +103,15 @@ class SetIntersectionIndex (SetIntersectionIndexBase):
         if max_symbols < 1 or max_symbols >= 2**64:
             raise ValueError ("max_sets")
         
+        if not isinstance (growth_factor, numbers.Number):
+            raise TypeError ("growth_factor")
+        
         if init_bucket_size < 4:
             raise ValueError ("init_bucket_size")
         
+        if not (growth_factor > 1):
+            raise ValueError ("growth_factor")
+        
         set_bits = int (round (math.log (max_sets, 2)))
         symbol_bits = int (round (math.log (max_symbols, 2)))
         
@@ -88,10 +148,15 @@ class SetIntersectionIndex (SetIntersectionIndexBase):
     
     @property
     def payloads (self):
-        for s in self._sets:
+        for s in self._sets[0:self._num_sets]:
             for pl in s:
                 yield pl
     
+    def get_payloads (self, sid):
+        if not 0 <= sid < self._num_sets:
+            raise IndexError ("sid")
+        return list (self._sets[sid])
+    
     @property
     def supports_most_frequent (self):
         return self._support_most_frequent
@@ -116,11 +181,413 @@ class SetIntersectionIndex (SetIntersectionIndexBase):
     def __setstate__ (self, state):
         self.__dict__ = state
         state["_packers"] = {}
+        state.setdefault ("_growth", 1.25)
+        state.setdefault ("_filters", {})
+        
+        sets_by_sig = state["_sets_by_sig"]
+        if sets_by_sig and isinstance (next (iter (sets_by_sig.values ())), list):
+            # older versions mapped signatures to payload lists instead of set ids
+            sids = dict ((id (S), sid) for sid, S in enumerate (state["_sets"][0:state["_num_sets"]]))
+            state["_sets_by_sig"] = dict ((sig, sids[id (S)]) for sig, S in sets_by_sig.items ())
+    
+    def _capacity (self, size, needed):
+        # new size for an array of `size` elements, that needs to fit `needed` elements
+        return max (needed, int(size * self._growth))
+    
+    def _grow_sets (self, size):
+        if self._sets.size < size:
+            self._sets = _grown (self._sets, size)
+        
+        if self._support_find_similar and self._set_sizes.size < size:
+            self._set_sizes = _grown (self._set_sizes, size)
+    
+    def reserve (self, sets=None, symbols=None, postings=None):
+        if sets is not None:
+            if sets > self._max_sets:
+                raise ValueError ("sets")
+            self._grow_sets (int(sets))
+        
+        if symbols is not None:
+            if symbols > self._max_symbols:
+                raise ValueError ("symbols")
+            if self._support_most_frequent and self._symbol_counts.size < symbols:
+                self._symbol_counts = _grown (self._symbol_counts, int(symbols))
+        
+        if postings is not None:
+            self._reserve_postings (postings)
+    
+    def _reserve_postings (self, postings):
+        pass  # backends without posting lists ignore it
+    
+    def memory_usage (self):
+        usage = self._memory_usage ()
+        usage["total"] = sum (usage.values ())
+        return usage
+    
+    def _table_usage (self):
+        # memory used by structures common to all backends deriving from _IndexBase
+        getsizeof = sys.getsizeof
+        symbols = self._symbols
+        sets_by_sig = self._sets_by_sig
+        
+        return {
+            "symbol_table": getsizeof (symbols) + getsizeof (self._index) + sum (getsizeof (s) for s in symbols),
+            "signatures": getsizeof (sets_by_sig) + sum (getsizeof (sig) for sig in sets_by_sig),
+            "payload_lists": self._sets.nbytes + sum (getsizeof (S) for S in self._sets[0:self._num_sets]),
+            "set_sizes": self._set_sizes.nbytes if self._support_find_similar else 0,
+            "symbol_counts": self._symbol_counts.nbytes if self._support_most_frequent else 0,
+            "filters": sum (mask.nbytes for mask in self._filters.values ()),
+        }
+    
+    def register_filter (self, name, sets):
+        if not isinstance (name, _string_types):
+            raise TypeError ("name")
+        
+        self._filters[name] = self._mask (sets)
+    
+    def unregister_filter (self, name):
+        del self._filters[name]
+    
+    def _mask (self, sets):
+        # boolean array indexed by set id, from a boolean array or set ids
+        if not isinstance (sets, numpy.ndarray):
+            # a list of booleans becomes a boolean array, a list of integers an array of set ids
+            sets = numpy.asarray (list (sets))
+            if not sets.size:
+                sets = sets.astype (numpy.int64)
+        
+        if sets.ndim != 1:
+            raise ValueError ("sets")
+        
+        if sets.dtype == bool:
+            return sets.copy ()
+        
+        if sets.dtype.kind not in "iu":
+            raise TypeError ("sets")
+        
+        if sets.size and (sets.min () < 0 or sets.max () >= self._num_sets):
+            raise ValueError ("sets")
+        
+        mask = numpy.zeros (self._num_sets, dtype=bool)
+        mask[sets] = True
+        return mask
+    
+    def _filter_mask (self, filter):
+        # boolean array covering all set ids, or None for no filtering
+        if filter is None:
+            return None
+        
+        if isinstance (filter, _string_types):
+            try:
+                mask = self._filters[filter]
+            except KeyError:
+                raise ValueError ("filter")
+            
+            if mask.size < self._num_sets:
+                # sets added after registering the filter don't pass it
+                mask = self._filters[filter] = _grown (mask, self._num_sets)
+            return mask
+        
+        mask = self._mask (filter)
+        if mask.size < self._num_sets:
+            mask = _grown (mask, self._num_sets)
+        return mask
     
     def add (self, iterable, payload=SetIntersectionIndexBase._SENTINEL):
         if payload is self._SENTINEL:
             payload = iterable
         
+        return self._add (iterable, payload, None)
+    
+    def _passing (self, sids, mask, sizes):
+        # Boolean array telling which of `sids` pass the filter `mask` and have sizes within the (min, max) range
+        # `sizes`, or None if all of them do.
+        
+        keep = mask[sids] if mask is not None else None
+        
+        if sizes is not None:
+            lo, hi = sizes
+            if lo is not None or hi is not None:
+                set_sizes = self._set_sizes[sids]
+                if lo is not None:
+                    ok = set_sizes >= lo * (1.0 - _EPSILON)
+                    keep = ok if keep is None else keep & ok
+                if hi is not None:
+                    ok = set_sizes <= hi * (1.0 + _EPSILON)
+                    keep = ok if keep is None else keep & ok
+        
+        return keep
+    
+    class SearchResults (SearchResults):
+        def __init__ (self, sids, scores, sets, processed=1.0):
+            self._sids = sids
+            self._scores = scores
+            self._sets = sets
+            self.processed = processed
+            self._order = None
+            self._list = None
+            self._list_for = None
+        
+        def _ranked (self, n):
+            # Indices of the best n results, by descending score.
+            # The ranked prefix is kept and only extended (at least doubled) when more results are asked for,
+            # by partially sorting the not yet ranked rest.
+            
+            scores = self._scores
+            size = scores.size
+            n = size if n is None else max (0, min (n, size))
+            if not n:
+                return numpy.arange (0)
+            
+            order = self._order
+            
+            if order is None or order.size < n:
+                ranked = 0 if order is None else order.size
+                want = min (size, max (n, 2 * ranked))
+                
+                if ranked == 0 and want == size:
+                    order = numpy.argsort (scores)[::-1]
+                else:
+                    if ranked:
+                        rest = numpy.ones (size, dtype=bool)
+                        rest[order] = False
+                        rest = numpy.nonzero (rest)[0]
+                    else:
+                        rest = numpy.arange (size)
+                    
+                    k = want - ranked
+                    if k < rest.size and _argpartition is not None:
+                        rest = rest[_argpartition (scores[rest], rest.size - k)[rest.size - k:]]
+                    rest = rest[numpy.argsort (scores[rest])[::-1][0:k]]
+                    
+                    order = rest if order is None else numpy.concatenate ((order, rest))
+                
+                self._order = order
+            
+            return order[0:n]
+        
+        def get (self, max_results=None):
+            order = self._ranked (max_results)
+            
+            return zip (self._scores[order], self._sets[self._sids[order]])
+        
+        def arrays (self, max_results=None):
+            order = self._ranked (max_results)
+            
+            return self._sids[order], self._scores[order]
+        
+        def page (self, offset, limit):
+            order = self._ranked (offset + limit)[offset:]
+            
+            return list (zip (self._scores[order], self._sets[self._sids[order]]))
+        
+        def __len__ (self):
+            return self._scores.size
+    
+    def _check_find (self, threshold):
+        if not isinstance (threshold, numbers.Number):
+            raise TypeError ("threshold")
+        
+        if threshold < 1 and threshold >= 0:
+            raise ValueError ("threshold")
+    
+    def _check_limits (self, max_candidates, deadline):
+        if max_candidates is not None:
+            if not isinstance (max_candidates, numbers.Integral):
+                raise TypeError ("max_candidates")
+            if max_candidates < 1:
+                raise ValueError ("max_candidates")
+        
+        if deadline is not None and not isinstance (deadline, numbers.Number):
+            raise TypeError ("deadline")
+    
+    def _find_results (self, L, sids, counts, threshold, processed):
+        if threshold < 0:
+            threshold = L + threshold
+            if threshold < 1:
+                raise ValueError ("threshold")
+        
+        if len (counts) == 0:
+            return EmptySearchResults (processed, self._dtype_sets, numpy.intp)
+        
+        mask = counts >= threshold
+        counts = counts[mask]
+        sids = sids[mask]
+        
+        return self.SearchResults (sids, counts, self._sets, processed)
+    
+    def find (self, iterable, threshold=1, max_results=None, filter=None, max_candidates=None, deadline=None):
+        self._check_find (threshold)
+        self._check_limits (max_candidates, deadline)
+        
+        L, sids, counts, processed = self._find (iterable, self._filter_mask (filter), max_candidates, deadline)
+        
+        return self._find_results (L, sids, counts, threshold, processed)
+    
+    def find_many (self, iterables, threshold=1, filter=None):
+        self._check_find (threshold)
+        
+        return [self._find_results (L, sids, counts, threshold, processed)
+                for L, sids, counts, processed in self._find_many (iterables, self._filter_mask (filter))]
+    
+    def _check_find_similar (self, threshold, measure):
+        if not isinstance (threshold, numbers.Number):
+            raise TypeError ("threshold")
+        
+        if threshold > 1 or not (threshold > 0):
+            raise ValueError ("threshold")
+        
+        try:
+            measure = _MEASURES[measure]
+        except KeyError:
+            raise ValueError ("measure")
+        
+        if not self._support_find_similar:
+            raise RuntimeError ("find_similar support disabled")
+        
+        return measure
+    
+    def _find_similar_results (self, L, sids, counts, threshold, measure, processed):
+        if len (counts) == 0:
+            return EmptySearchResults (processed, self._dtype_sets, numpy.float64)
+        
+        # sets whose size alone rules them out were not counted, see _size_range
+        score, bounds = measure
+        smls = score (counts, L * 1.0, self._set_sizes[sids])
+        
+        mask = smls >= threshold
+        smls = smls[mask]
+        sids = sids[mask]
+        
+        return self.SearchResults (sids, smls, self._sets, processed)
+    
+    @staticmethod
+    def _size_range (measure, threshold):
+        # function of the query size, returning the range of sizes of sets which can reach the threshold
+        bounds = measure[1]
+        return lambda L: bounds (L * 1.0, threshold)
+    
+    def find_similar (self, iterable, threshold=0.3, measure="jaccard", filter=None, max_candidates=None, deadline=None):
+        measure = self._check_find_similar (threshold, measure)
+        self._check_limits (max_candidates, deadline)
+        
+        L, sids, counts, processed = self._find (iterable, self._filter_mask (filter), max_candidates, deadline,
+                                                 self._size_range (measure, threshold))
+        
+        return self._find_similar_results (L, sids, counts, threshold, measure, processed)
+    
+    def find_similar_many (self, iterables, threshold=0.3, measure="jaccard", filter=None):
+        measure = self._check_find_similar (threshold, measure)
+        
+        return [self._find_similar_results (L, sids, counts, threshold, measure, processed)
+                for L, sids, counts, processed in self._find_many (iterables, self._filter_mask (filter),
+                                                                   self._size_range (measure, threshold))]
+    
+    def most_frequent (self, threshold=2.0/3.0, max_results=None, with_counts=False):
+        if not self._support_most_frequent:
+            raise RuntimeError ("most_frequent support disabled")
+        
+        counts = self._symbol_counts
+        if self._num_sets == 0:
+            return
+        
+        sort = numpy.argsort (counts[0:len(self._symbols)])
+        limit = counts[sort[-1]] * 1.0 * threshold
+        
+        symbols = self._symbols
+        
+        if max_results:
+            sort = sort[-max_results:]
+        
+        if with_counts:
+            for x in sort[::-1]:
+                count = counts[x]
+                if count < limit:
+                    break
+                yield (symbols[x], count)
+        else:
+            for x in sort[::-1]:
+                count = counts[x]
+                if count < limit:
+                    break
+                yield symbols[x]
+
+class SetIntersectionIndex (_IndexBase):
+    def __init__ (self,
+                  max_sets=2**32,
+                  max_symbols=2**16,
+                  init_bucket_size=16,
+                  support_most_frequent=True,
+                  support_find_similar=True,
+                  growth_factor=1.25):
+        
+        # the symbol table maps symbols to [symbol id, number of sets, array of set ids] buckets
+        _IndexBase.__init__ (self,
+                             max_sets=max_sets,
+                             max_symbols=max_symbols,
+                             init_bucket_size=init_bucket_size,
+                             support_most_frequent=support_most_frequent,
+                             support_find_similar=support_find_similar,
+                             growth_factor=growth_factor)
+        
+        self._reserved = {}
+    
+    def __setstate__ (self, state):
+        _IndexBase.__setstate__ (self, state)
+        state.setdefault ("_reserved", {})
+    
+    def _reserve_postings (self, postings):
+        if isinstance (postings, numbers.Number):
+            # only symbols already in the index, new symbols keep starting with init_bucket_size
+            wanted = [(bucket, postings) for bucket in self._index.values ()]
+        else:
+            wanted = []
+            for symbol, count in postings.items ():
+                bucket = self._index.get (symbol)
+                if bucket is None:
+                    self._reserved[symbol] = max (count, self._reserved.get (symbol, 0))
+                else:
+                    wanted.append ((bucket, count))
+        
+        for bucket, count in wanted:
+            if bucket[2].size < count:
+                bucket[2] = _grown (bucket[2], int(count))
+    
+    def _memory_usage (self):
+        getsizeof = sys.getsizeof
+        usage = self._table_usage ()
+        used = slack = 0
+        
+        for bucket in self._index.values ():
+            arr = bucket[2]
+            n = bucket[1] * arr.itemsize
+            used += n
+            slack += arr.nbytes - n
+            usage["symbol_table"] += getsizeof (bucket) + getsizeof (arr) - arr.nbytes
+        
+        usage["postings_used"] = used
+        usage["postings_slack"] = slack
+        return usage
+    
+    def add_many (self, items):
+        # postings are collected per bucket and appended once at the end,
+        # so each bucket array grows at most once per call
+        pending = {}
+        try:
+            for iterable, payload in items:
+                self._add (iterable, payload, pending)
+        finally:
+            dtype = self._dtype_sets
+            for bucket, sids in pending.values ():
+                idx = bucket[1]
+                end = idx + len (sids)
+                arr = bucket[2]
+                if arr.size < end:
+                    arr = bucket[2] = _grown (arr, self._capacity (arr.size, end))
+                arr[idx:end] = numpy.array (sids, dtype=dtype)
+                bucket[1] = end
+    
+    def _add (self, iterable, payload, pending):
         max_sets = self._max_sets
         max_symbols = self._max_symbols
         init_bs = self._init_bs
@@ -143,7 +610,8 @@ class SetIntersectionIndex (SetIntersectionIndexBase):
                 if id >= max_symbols:
                     raise RuntimeError ("index full: maximum number of symbols reached")
                 
-                bucket = index[symbol] = [id, 0, numpy.zeros (init_bs, dtype=self._dtype_sets)]
+                bs = max (init_bs, self._reserved.pop (symbol, 0)) if self._reserved else init_bs
+                bucket = index[symbol] = [id, 0, numpy.zeros (bs, dtype=self._dtype_sets)]
                 symbols.append (symbol)
             
             buckets.append (bucket)
@@ -157,8 +625,8 @@ class SetIntersectionIndex (SetIntersectionIndexBase):
         packer = self._packers[lsig] = self._packers.get(lsig) or struct.Struct(self._struct_symbols * lsig).pack
         ssig = packer (*sig)
         
-        S = self._sets_by_sig.get (ssig)
-        if S is None:
+        sid = self._sets_by_sig.get (ssig)
+        if sid is None:
             # register new set
             
             sid = self._num_sets
@@ -166,26 +634,32 @@ class SetIntersectionIndex (SetIntersectionIndexBase):
                 raise RuntimeError ("index full: maximum number of sets reached")
             
             self._num_sets += 1
-            sets = self._sets
-            if sid >= sets.size:
-                sets = self._sets = numpy.resize (sets, int(sid * 1.25))
+            if sid >= self._sets.size:
+                self._grow_sets (self._capacity (self._sets.size, sid + 1))
             
-            S = self._sets_by_sig[ssig] = []
-            sets[sid] = S
+            self._sets_by_sig[ssig] = sid
+            self._sets[sid] = []
             
             if self._support_find_similar:
                 if self._set_sizes.size <= sid:
-                    self._set_sizes = numpy.resize (self._set_sizes, int(sid * 1.25))
+                    self._set_sizes = _grown (self._set_sizes, self._capacity (self._set_sizes.size, sid + 1))
                 self._set_sizes[sid] = len (buckets)
             
             # add set to per-symbol buckets
-            for bucket in buckets:
-                arr = bucket[2]
-                idx = bucket[1]
-                if arr.size <= idx:
-                    arr = bucket[2] = numpy.resize (arr, int(idx * 1.25))
-                arr[idx] = sid
-                bucket[1] += 1
+            if pending is not None:
+                for bucket in buckets:
+                    entry = pending.get (bucket[0])
+                    if entry is None:
+                        entry = pending[bucket[0]] = (bucket, [])
+                    entry[1].append (sid)
+            else:
+                for bucket in buckets:
+                    arr = bucket[2]
+                    idx = bucket[1]
+                    if arr.size <= idx:
+                        arr = bucket[2] = _grown (arr, self._capacity (arr.size, idx + 1))
+                    arr[idx] = sid
+                    bucket[1] += 1
         
         if self._support_most_frequent:
             # update counts of symbol occurrences
@@ -194,8 +668,7 @@ class SetIntersectionIndex (SetIntersectionIndexBase):
             
             new_syms = len (symbols)
             if new_syms > num_syms and new_syms >= symbol_counts.size:
-                self._symbol_counts = symbol_counts = numpy.resize (symbol_counts, int(new_syms * 1.25))
-                symbol_counts[num_syms:new_syms] = 0
+                self._symbol_counts = symbol_counts = _grown (symbol_counts, self._capacity (symbol_counts.size, new_syms + 1))
             
             if len (sig) == len (buckets): #no repetitions
                 symbol_counts[ numpy.array (sig, dtype=self._dtype_symbols) ] += 1
@@ -203,127 +676,312 @@ class SetIntersectionIndex (SetIntersectionIndexBase):
                 for bucket in buckets:
                     symbol_counts[bucket[0]] += 1
         
-        S.append (payload)
+        self._sets[sid].append (payload)
+        return sid
     
-    def _find (self, iterable):
+    def _find (self, iterable, mask=None, max_candidates=None, deadline=None, size_range=None):
+        # Returns: (query size, set ids, intersection counts, fraction of postings processed)
+        # `size_range` is a function of the query size, returning the range of sizes of sets to count.
+        
         buckets = []
-        sig = set()
-        occurrences = []
         L = 0
         
         for symbol in iterable:
             L += 1
             bucket = self._index.get (symbol)
-            if bucket is not None:
+            if bucket is not None and bucket[1]:
                 buckets.append (bucket)
-                sig.add (bucket[0])
-                if bucket[1]:
-                    occurrences.append (bucket[2][0:bucket[1]])
-        
-        if occurrences:
-            sids, indices = numpy.unique (numpy.concatenate (occurrences), return_inverse=True)
-            counts = numpy.bincount (indices)
         
-            return L, sids, indices, counts
-        else:
-            return L, [], [], []
-    
-    class SearchResults (SearchResults):
-        def __init__ (self, sids, scores, sets):
-            self._sids = sids
-            self._scores = scores
-            self._sets = sets
-            self._sort = None
-            self._list = None
-            self._list_for = None
-            
-        def get (self, max_results=None):
-            scores = self._scores
-            sort = self._sort = self._sort or numpy.argsort (scores)
-            
-            if max_results is not None:
-                sort = sort[-max_results:]
-            
-            sort = sort[::-1]
-            r_sids = self._sids[sort]
-            r_counts = scores[sort]
+        sizes = size_range (L) if size_range is not None else None
+        
+        if max_candidates is None and deadline is None:
+            if not buckets:
+                return L, [], [], 1.0
+            sids, counts = self._count ([bucket[2][0:bucket[1]] for bucket in buckets], mask, sizes)
+            return L, sids, counts, 1.0
+        
+        # Posting lists are processed rarest first, so that stopping early at a limit skips the most common symbols,
+        # which are the most expensive and the least selective ones. With a deadline, postings are counted in chunks
+        # sized to fit the time left, checking the clock in between.
+        
+        buckets.sort (key=lambda bucket: bucket[1])
+        total = sum (bucket[1] for bucket in buckets)
+        budget = total if max_candidates is None else min (total, max_candidates)
+        chunk = budget if deadline is None else min (budget, _CHUNK)
+        started = time.time ()
+        expired = deadline is not None and started >= deadline
+        
+        sids = counts = None
+        pending = []
+        gathered = taken = 0
+        
+        for bucket in buckets:
+            arr = bucket[2]
+            pos = 0
+            while pos < bucket[1] and taken < budget and not expired:
+                n = min (bucket[1] - pos, budget - taken, chunk - gathered)
+                pending.append (arr[pos:pos + n])
+                pos += n
+                taken += n
+                gathered += n
+                
+                if gathered >= chunk and deadline is not None:
+                    sids, counts = self._count (pending, mask, sizes, sids, counts)
+                    pending = []
+                    gathered = 0
+                    
+                    now = time.time ()
+                    expired = now >= deadline
+                    # grow chunks geometrically, but not beyond what's likely to be counted in the time left
+                    rate = taken / max (now - started, _EPSILON)
+                    chunk = max (_CHUNK, min (2 * chunk, int ((deadline - now) * rate)))
             
-            return zip (r_counts, self._sets[r_sids])
+            if taken >= budget or expired:
+                break
         
-        def __len__ (self):
-            return self._scores.size
+        if pending:
+            sids, counts = self._count (pending, mask, sizes, sids, counts)
+        
+        processed = taken * 1.0 / total if total else 1.0
+        if sids is None or not sids.size:
+            return L, [], [], processed
+        return L, sids, counts, processed
     
-    def find (self, iterable, threshold=1, max_results=None):
-        if not isinstance (threshold, numbers.Number):
-            raise TypeError ("threshold")
+    def _count (self, occurrences, mask, sizes, sids=None, counts=None):
+        # Unique set ids found in the `occurrences` arrays and their counts, added to earlier counts of sets `sids`.
         
-        if threshold < 1 and threshold >= 0:
-            raise ValueError ("threshold")
+        occurrences = numpy.concatenate (occurrences)
         
-        L, sids, indices, counts = self._find (iterable)
+        # filtered out sets, and sets whose size alone rules them out, are dropped before the costly unique/bincount pass
+        keep = self._passing (occurrences, mask, sizes)
+        if keep is not None:
+            occurrences = occurrences[keep]
         
-        if threshold < 0:
-            threshold = L + threshold
-            if threshold < 1:
-                raise ValueError ("threshold")
+        if sids is None:
+            new_sids, indices = numpy.unique (occurrences, return_inverse=True)
+            return new_sids, numpy.bincount (indices)
         
-        if len (counts) == 0:
-            return EmptySearchResults ()
+        new_sids, indices = numpy.unique (numpy.concatenate ((sids, occurrences)), return_inverse=True)
+        counts = numpy.bincount (indices[0:sids.size], weights=counts, minlength=new_sids.size)\
+                 + numpy.bincount (indices[sids.size:], minlength=new_sids.size)
+        return new_sids, counts.astype (numpy.int64)
+    
+    def _find_many (self, iterables, mask=None, size_range=None):
+        # Evaluates several queries at once: posting lists of all the queries are tagged with the query's
+        # number and counted in a single unique/bincount pass.
         
-        mask = counts >= threshold
-        counts = counts[mask]
-        sids = sids[mask]
+        index = self._index
+        stride = max (self._num_sets, 1)
+        lengths = []
+        occurrences = []
         
-        return self.SearchResults (sids, counts, self._sets)
+        for q, iterable in enumerate (iterables):
+            L = 0
+            buckets = []
+            for symbol in iterable:
+                L += 1
+                bucket = index.get (symbol)
+                if bucket is not None and bucket[1]:
+                    buckets.append (bucket)
+            lengths.append (L)
+            
+            sizes = size_range (L) if size_range is not None else None
+            for bucket in buckets:
+                occ = bucket[2][0:bucket[1]]
+                keep = self._passing (occ, mask, sizes)
+                if keep is not None:
+                    occ = occ[keep]
+                occ = occ.astype (numpy.int64)
+                occ += q * stride
+                occurrences.append (occ)
+        
+        if not occurrences:
+            return [(L, [], [], 1.0) for L in lengths]
+        
+        keys, indices = numpy.unique (numpy.concatenate (occurrences), return_inverse=True)
+        counts = numpy.bincount (indices)
+        queries = keys // stride
+        sids = (keys - queries * stride).astype (self._dtype_sets)
+        bounds = numpy.searchsorted (queries, numpy.arange (len (lengths) + 1))
+        
+        return [(L, sids[bounds[q]:bounds[q+1]], counts[bounds[q]:bounds[q+1]], 1.0)
+                for q, L in enumerate (lengths)]
+    
+    def _postings (self):
+        # all (symbol id, set id) pairs
+        buckets = [bucket for bucket in self._index.values () if bucket[1]]
+        if not buckets:
+            return numpy.zeros (0, dtype=numpy.int64), numpy.zeros (0, dtype=numpy.int64)
+        
+        symbols = numpy.repeat (numpy.array ([bucket[0] for bucket in buckets], dtype=numpy.int64),
+                                [bucket[1] for bucket in buckets])
+        sids = numpy.concatenate ([bucket[2][0:bucket[1]] for bucket in buckets]).astype (numpy.int64)
+        return symbols, sids
     
-    def find_similar (self, iterable, threshold=0.3):
+    @staticmethod
+    def _ranked_sets (ranks, sids, num_sets):
+        # Symbol ranks of every set, in CSR form: ascending ranks of set `sid` are ranks[indptr[sid]:indptr[sid+1]]
+        
+        order = numpy.lexsort ((ranks, sids))
+        ranks = ranks[order]
+        sids = sids[order]
+        
+        # a set's posting is repeated if the set was added with a repeated symbol
+        keep = numpy.ones (ranks.size, dtype=bool)
+        keep[1:] = (ranks[1:] != ranks[:-1]) | (sids[1:] != sids[:-1])
+        ranks = ranks[keep]
+        sids = sids[keep]
+        
+        sizes = numpy.bincount (sids, minlength=num_sets)
+        indptr = numpy.zeros (num_sets + 1, dtype=numpy.int64)
+        numpy.cumsum (sizes, out=indptr[1:])
+        return ranks, sids, sizes, indptr
+    
+    def similarity_join (self, threshold, other=None, measure="jaccard", chunk_size=2**20):
         if not isinstance (threshold, numbers.Number):
             raise TypeError ("threshold")
         
         if threshold > 1 or not (threshold > 0):
             raise ValueError ("threshold")
         
-        if not self._support_find_similar:
-            raise RuntimeError ("find_similar support disabled")
-        
-        L, sids, indices, counts = self._find (iterable)
+        if measure not in _MIN_OVERLAPS:
+            raise ValueError ("measure")
+        score, bounds = _MEASURES[measure]
+        min_overlap = _MIN_OVERLAPS[measure]
         
-        if len (counts) == 0:
-            return EmptySearchResults ()
-        
-        smls = counts / (self._set_sizes[sids] + (L * 1.0) - counts)
-        
-        mask = smls >= threshold
-        smls = smls[mask]
-        sids = sids[mask]
-        
-        return self.SearchResults (sids, smls, self._sets)
-    
-    def most_frequent (self, threshold=2.0/3.0, max_results=None, with_counts=False):
-        if not self._support_most_frequent:
-            raise RuntimeError ("most_frequent support disabled")
-        
-        counts = self._symbol_counts
-        if self._num_sets == 0:
-            return
+        if other is not None:
+            other = getattr (other, "index", other)  # e.g. a JournaledIndex
+            if not isinstance (other, SetIntersectionIndex):
+                raise TypeError ("other")
         
-        sort = numpy.argsort (counts[0:len(self._symbols)])
-        limit = counts[sort[-1]] * 1.0 * threshold
+        # Map symbols of both indexes to a common id space and rank them by ascending number of sets they occur in.
+        # Rare symbols come first in the prefixes, which keeps the number of candidate pairs low.
         
-        symbols = self._symbols
+        symbols, sids = self._postings ()
+        num_symbols = len (self._symbols)
         
-        if max_results:
-            sort = sort[-max_results:]
+        if other is None or other is self:
+            o_symbols, o_sids = symbols, sids
+            o_num_sets = self._num_sets
+            o_dtype_sets = self._dtype_sets
+        else:
+            o_symbols, o_sids = other._postings ()
+            o_num_sets = other._num_sets
+            o_dtype_sets = other._dtype_sets
+            
+            index = self._index
+            mapping = numpy.zeros (len (other._symbols), dtype=numpy.int64)
+            for id, symbol in enumerate (other._symbols):
+                bucket = index.get (symbol)
+                if bucket is None:
+                    mapping[id] = num_symbols
+                    num_symbols += 1
+                else:
+                    mapping[id] = bucket[0]
+            o_symbols = mapping[o_symbols]
+        
+        frequency = numpy.bincount (symbols, minlength=num_symbols)
+        if o_symbols is not symbols:
+            frequency += numpy.bincount (o_symbols, minlength=num_symbols)
+        rank = numpy.empty (num_symbols, dtype=numpy.int64)
+        rank[numpy.argsort (frequency, kind="mergesort")] = numpy.arange (num_symbols)
+        
+        ranks, sids, sizes, indptr = self._ranked_sets (rank[symbols], sids, self._num_sets)
+        if o_symbols is symbols:
+            o_ranks, o_sids, o_sizes, o_indptr = ranks, sids, sizes, indptr
+        else:
+            o_ranks, o_sids, o_sizes, o_indptr = self._ranked_sets (rank[o_symbols], o_sids, o_num_sets)
         
-        if with_counts:
-            for x in sort[::-1]:
-                count = counts[x]
-                if count < limit:
-                    break
-                yield (symbols[x], count)
+        def prefixes (ranks, sids, sizes, indptr):
+            # Entries of set prefixes and their positions in sets, sorted by (rank, set id).
+            # Two sets reaching the threshold must have a common symbol within prefixes of length |x| - o + 1,
+            # where o is the minimal overlap of x with any set, given the smallest size that set can have.
+            
+            overlap = numpy.ceil (bounds (sizes * 1.0, threshold)[0] * (1.0 - _EPSILON))
+            length = numpy.clip (sizes - overlap + 1, 0, sizes).astype (numpy.int64)
+            positions = numpy.arange (ranks.size) - indptr[sids]
+            keep = positions < length[sids]
+            
+            ranks = ranks[keep]
+            sids = sids[keep]
+            positions = positions[keep]
+            order = numpy.lexsort ((sids, ranks))
+            return ranks[order], sids[order], positions[order]
+        
+        p_ranks, p_sids, p_positions = prefixes (ranks, sids, sizes, indptr)
+        
+        if o_ranks is ranks:
+            # self join: pair each entry with the following entries of the same symbol, so each pair is found once
+            q_ranks, q_sids, q_positions = p_ranks, p_sids, p_positions
+            starts = numpy.arange (1, p_ranks.size + 1)
+            ends = numpy.searchsorted (p_ranks, p_ranks, side="right")
         else:
-            for x in sort[::-1]:
-                count = counts[x]
-                if count < limit:
-                    break
-                yield symbols[x]
+            q_ranks, q_sids, q_positions = prefixes (o_ranks, o_sids, o_sizes, o_indptr)
+            starts = numpy.searchsorted (q_ranks, p_ranks, side="left")
+            ends = numpy.searchsorted (q_ranks, p_ranks, side="right")
+        counts = numpy.maximum (ends - starts, 0)
+        
+        # split sets of this index into chunks producing at most chunk_size candidate pairs each
+        # (or a single set producing more), pairs of one set all fall into one chunk, so deduplication is local
+        per_set = numpy.bincount (p_sids, weights=counts, minlength=self._num_sets)
+        cumulative = numpy.cumsum (per_set)
+        chunk_bounds = [0]
+        while chunk_bounds[-1] < self._num_sets:
+            done = cumulative[chunk_bounds[-1] - 1] if chunk_bounds[-1] else 0
+            end = int (numpy.searchsorted (cumulative, done + chunk_size, side="right"))
+            chunk_bounds.append (min (self._num_sets, max (end, chunk_bounds[-1] + 1)))
+        
+        set_order = numpy.argsort (p_sids, kind="mergesort")
+        set_bounds = numpy.searchsorted (p_sids[set_order], chunk_bounds)
+        
+        def chunks ():
+            # candidate generation and verification, chunk by chunk
+            
+            for lo, hi in zip (set_bounds[:-1], set_bounds[1:]):
+                entries = set_order[lo:hi]
+                entries = entries[counts[entries] > 0]
+                if not entries.size:
+                    continue
+                
+                c = counts[entries]
+                a = numpy.repeat (p_sids[entries], c)
+                q = _ranges (starts[entries], c)
+                b = q_sids[q]
+                
+                # size filtering
+                size_a = sizes[a] * 1.0
+                size_b = o_sizes[b]
+                min_size, max_size = bounds (size_a, threshold)
+                mask = (size_b >= min_size * (1.0 - _EPSILON)) & (size_b <= max_size * (1.0 + _EPSILON))
+                
+                # positional filtering: if this symbol is the first one common to both sets, the overlap can't exceed
+                # the number of symbols from this one on in the smaller rest, a similar pair passes at its first
+                # common symbol, so filtered out candidates from other common symbols are only duplicates
+                rest = numpy.minimum (size_a - numpy.repeat (p_positions[entries], c), size_b - q_positions[q])
+                mask &= rest >= min_overlap (size_a, size_b, threshold) * (1.0 - _EPSILON)
+                
+                keys = numpy.unique (a[mask] * o_num_sets + b[mask])
+                if not keys.size:
+                    continue
+                a = keys // o_num_sets
+                b = keys - a * o_num_sets
+                
+                # verification, by counting ranks common to both sets of each pair
+                n = a.size
+                la = sizes[a]
+                lb = o_sizes[b]
+                pairs = numpy.concatenate ((numpy.repeat (numpy.arange (n), la), numpy.repeat (numpy.arange (n), lb)))
+                common = numpy.concatenate ((ranks[_ranges (indptr[a], la)], o_ranks[_ranges (o_indptr[b], lb)]))
+                
+                merged = numpy.sort (pairs * num_symbols + common)
+                dup = merged[1:][merged[1:] == merged[:-1]]
+                inter = numpy.bincount (dup // num_symbols, minlength=n)
+                
+                smls = score (inter, la * 1.0, lb)
+                mask = smls >= threshold
+                if mask.any ():
+                    yield a[mask].astype (self._dtype_sets), b[mask].astype (o_dtype_sets), smls[mask]
+        
+        # arguments are checked and candidate prefixes built right away, while pairs are produced lazily
+        return chunks ()
+
@@ -0,0 +1,424 @@
+"""
+Durable set intersection indexes, backed by a snapshot and an append-only journal.
+
+Every set added to a JournaledIndex is appended to the journal as a compact binary record of symbol ids and payload.
+On startup the journal is replayed on top of the last snapshot, and `checkpoint` folds the journal into a new snapshot
+in a background thread, without stalling ingestion.
+
+A JournaledIndex can also be used as the `set_index` of a TrigramIndex.
+"""
+
+import os
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from . import SetIntersectionIndexBase, SetIntersectionIndex
+
+_replace = getattr (os, "replace", os.rename)
+
+_PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+_HEADER = struct.Struct ("<BII")  # record type, body length, crc32 of body
+_COUNT = struct.Struct ("<I")
+
+# record types
+_SYMBOL = 1        # body: pickled symbol, which gets the next segment-local symbol id
+_ADD = 2           # body: symbol count, symbol ids, pickled payload
+_ADD_ITERABLE = 3  # body: symbol count, symbol ids - the payload is the tuple of symbols
+
+_SNAPSHOT = "snapshot"
+_SEGMENT = "journal."
+
+def _fsync_dir (path):
+    # makes creation, renaming and removal of files in the directory durable
+    try:
+        fd = os.open (path, os.O_RDONLY)
+    except OSError:
+        return  # directories can't be opened on some platforms, eg. Windows
+    try:
+        os.fsync (fd)
+    except OSError:
+        pass
+    finally:
+        os.close (fd)
+
+def _record (kind, body):
+    return _HEADER.pack (kind, len (body), zlib.crc32 (body) & 0xffffffff) + body
+
+def _read_segment (path):
+    """
+    Yields (symbols, payload) pairs recorded in a journal segment.
+    Stops at the first truncated or damaged record, which can only be the tail of a segment written during a crash.
+    """
+    
+    symbols = []
+    
+    with open (path, "rb") as f:
+        while True:
+            header = f.read (_HEADER.size)
+            if len (header) < _HEADER.size:
+                return
+            
+            kind, length, crc = _HEADER.unpack (header)
+            body = f.read (length)
+            if len (body) < length or zlib.crc32 (body) & 0xffffffff != crc:
+                return
+            
+            if kind == _SYMBOL:
+                symbols.append (pickle.loads (body))
+            elif kind == _ADD or kind == _ADD_ITERABLE:
+                n, = _COUNT.unpack_from (body)
+                ids = struct.unpack_from ("<%dI" % n, body, _COUNT.size)
+                iterable = tuple ([symbols[i] for i in ids])
+                if kind == _ADD:
+                    yield iterable, pickle.loads (body[_COUNT.size * (n + 1):])
+                else:
+                    yield iterable, iterable
+            else:
+                return
+
+class JournaledIndex (SetIntersectionIndexBase):
+    """
+    A set intersection index persisted in a directory, as a snapshot and journal segments.
+    
+    Queries are answered by the wrapped `index`, which is also available as an attribute.
+    Sets are stored in the journal as tuples, so if the payload of a set is the iterable itself, it becomes a tuple.
+    """
+    
+    def __init__ (self, path, sync_every=1000, sync_interval=1.0, **kwargs):
+        """
+        Open or create a journaled index.
+        
+        Arguments:
+        
+        path
+            Directory holding the snapshot and journal, created if necessary.
+        
+        Keyword arguments:
+        
+        sync_every (default: 1000, min: 1)
+            Max number of records written to the journal between fsync calls.
+            Records are handed to the operating system as they are added, so only a system crash can lose those.
+        
+        sync_interval (default: 1.0)
+            Max time in seconds between fsync calls, checked when adding sets. None disables the time limit.
+        
+        Other keyword arguments are passed to the `SetIntersectionIndex` factory function, when there's no snapshot
+        to load the index from.
+        """
+        
+        if sync_every < 1:
+            raise ValueError ("sync_every")
+        
+        self._path = path
+        self._kwargs = kwargs
+        self._sync_every = sync_every
+        self._sync_interval = sync_interval
+        self._lock = threading.Lock ()
+        self._checkpoint_lock = threading.Lock ()
+        self._checkpointer = None
+        self._checkpoint_error = None
+        self._file = None
+        
+        if not os.path.isdir (path):
+            os.makedirs (path)
+        
+        base, index = self._load_snapshot ()
+        segments = self._segments ()
+        
+        for gen in segments:
+            if gen < base:
+                os.remove (self._segment_path (gen))
+        
+        segments = [gen for gen in segments if gen >= base]
+        index.add_many (item for gen in segments for item in _read_segment (self._segment_path (gen)))
+        
+        self.index = index
+        self._open_segment (max (segments + [base]) + 1)
+    
+    def __getattr__ (self, name):
+        # backend specific extensions
+        if name == "index":
+            raise AttributeError (name)
+        return getattr (self.index, name)
+    
+    def _segment_path (self, gen):
+        return os.path.join (self._path, _SEGMENT + "%08d" % gen)
+    
+    def _segments (self):
+        return sorted (int (fn[len (_SEGMENT):]) for fn in os.listdir (self._path)
+                       if fn.startswith (_SEGMENT) and fn[len (_SEGMENT):].isdigit ())
+    
+    def _load_snapshot (self):
+        path = os.path.join (self._path, _SNAPSHOT)
+        if not os.path.exists (path):
+            return 0, SetIntersectionIndex (**self._kwargs)
+        
+        with open (path, "rb") as f:
+            return pickle.load (f)
+    
+    def _open_segment (self, gen):
+        self._gen = gen
+        self._file = open (self._segment_path (gen), "ab")
+        _fsync_dir (self._path)
+        self._symbol_ids = {}
+        self._unsynced = 0
+        self._synced_at = time.time ()
+    
+    def _sync (self):
+        self._file.flush ()
+        os.fsync (self._file.fileno ())
+        self._unsynced = 0
+        self._synced_at = time.time ()
+    
+    def _log (self, iterable, payload, records, new_ids):
+        # Symbols first seen here get ids in `new_ids`, which are merged into the segment's symbol ids
+        # only once the records are written.
+        symbol_ids = self._symbol_ids
+        ids = []
+        
+        for symbol in iterable:
+            id = symbol_ids.get (symbol)
+            if id is None:
+                id = new_ids.get (symbol)
+                if id is None:
+                    id = new_ids[symbol] = len (symbol_ids) + len (new_ids)
+                    records.append (_record (_SYMBOL, pickle.dumps (symbol, _PROTOCOL)))
+            ids.append (id)
+        
+        body = struct.pack ("<I%dI" % len (ids), len (ids), *ids)
+        if payload is iterable:
+            records.append (_record (_ADD_ITERABLE, body))
+        else:
+            records.append (_record (_ADD, body + pickle.dumps (payload, _PROTOCOL)))
+    
+    def _write (self, records, count, new_ids):
+        pos = self._file.tell ()
+        try:
+            self._file.write (b"".join (records))
+            self._file.flush ()
+        except Exception:
+            # drop a partially written record, so that records appended later can still be replayed
+            try:
+                self._file.seek (pos)
+                self._file.truncate ()
+            except Exception:
+                pass
+            raise
+        
+        self._symbol_ids.update (new_ids)
+        
+        self._unsynced += count
+        if self._unsynced >= self._sync_every\
+        or (self._sync_interval is not None and time.time () - self._synced_at >= self._sync_interval):
+            self._sync ()
+    
+    @property
+    def symbol_count (self):
+        return self.index.symbol_count
+    
+    @property
+    def set_count (self):
+        return self.index.set_count
+    
+    @property
+    def symbols (self):
+        return self.index.symbols
+    
+    @property
+    def payloads (self):
+        return self.index.payloads
+    
+    @property
+    def supports_most_frequent (self):
+        return self.index.supports_most_frequent
+    
+    @property
+    def supports_find_similar (self):
+        return self.index.supports_find_similar
+    
+    @property
+    def max_sets (self):
+        return self.index.max_sets
+    
+    @property
+    def max_symbols (self):
+        return self.index.max_symbols
+    
+    def get_payloads (self, sid):
+        return self.index.get_payloads (sid)
+    
+    def memory_usage (self):
+        return self.index.memory_usage ()
+    
+    def reserve (self, sets=None, symbols=None, postings=None):
+        return self.index.reserve (sets, symbols, postings)
+    
+    def register_filter (self, name, sets):
+        # filters are not journaled, they're derived from set ids and payloads which are
+        return self.index.register_filter (name, sets)
+    
+    def unregister_filter (self, name):
+        return self.index.unregister_filter (name)
+    
+    def add (self, iterable, payload=SetIntersectionIndexBase._SENTINEL):
+        iterable = tuple (iterable)
+        if payload is self._SENTINEL:
+            payload = iterable
+        
+        with self._lock:
+            # records are built (and payloads pickled) first, and written only if the index accepted the set
+            records = []
+            new_ids = {}
+            self._log (iterable, payload, records, new_ids)
+            
+            result = self.index.add (iterable, payload)
+            self._write (records, 1, new_ids)
+        
+        return result
+    
+    def add_many (self, items):
+        items = [(tuple (iterable), payload) for iterable, payload in items]
+        
+        with self._lock:
+            records = []
+            new_ids = {}
+            ends = []  # numbers of records and of new symbols logged up to each item
+            for iterable, payload in items:
+                self._log (iterable, payload, records, new_ids)
+                ends.append ((len (records), len (new_ids)))
+            
+            applied = [0]
+            def applying ():
+                # counts items the index asked past, ie. applied, as indexes add them in order
+                for item in items:
+                    yield item
+                    applied[0] += 1
+            
+            try:
+                self.index.add_many (applying ())
+            except Exception:
+                # sets added before the failure stay in the index, so they're journaled too
+                n = applied[0]
+                if n:
+                    num_records, num_symbols = ends[n - 1]
+                    base = len (self._symbol_ids)
+                    self._write (records[0:num_records], n,
+                                 dict ((symbol, id) for symbol, id in new_ids.items () if id < base + num_symbols))
+                raise
+            
+            self._write (records, len (items), new_ids)
+    
+    def find (self, iterable, threshold=1, max_results=None, filter=None, max_candidates=None, deadline=None):
+        return self.index.find (iterable, threshold, max_results, filter, max_candidates, deadline)
+    
+    def find_similar (self, iterable, threshold=0.3, measure="jaccard", filter=None, max_candidates=None, deadline=None):
+        return self.index.find_similar (iterable, threshold, measure, filter, max_candidates, deadline)
+    
+    def find_many (self, iterables, threshold=1, filter=None):
+        return self.index.find_many (iterables, threshold, filter)
+    
+    def find_similar_many (self, iterables, threshold=0.3, measure="jaccard", filter=None):
+        return self.index.find_similar_many (iterables, threshold, measure, filter)
+    
+    def similarity_join (self, threshold, other=None, measure="jaccard", chunk_size=2**20):
+        return self.index.similarity_join (threshold, other, measure, chunk_size)
+    
+    def most_frequent (self, threshold=2.0/3.0, max_results=None, with_counts=False):
+        return self.index.most_frequent (threshold, max_results, with_counts)
+    
+    def sync (self):
+        """
+        Force all journal records to disk.
+        """
+        
+        with self._lock:
+            self._sync ()
+    
+    def checkpoint (self, wait=False):
+        """
+        Fold the journal written so far into a new snapshot.
+        
+        The journal is switched to a new segment, then a background thread loads the previous snapshot, replays
+        the older segments on top of it, saves the result as the new snapshot and removes the replayed segments.
+        The live index is not touched, so adding sets can continue meanwhile.
+        
+        Keyword arguments:
+        
+        wait (default: False)
+            Boolean indicating whether to wait for the new snapshot to be written.
+        
+        Returns: the background thread.
+        """
+        
+        with self._checkpoint_lock:
+            # a running checkpoint is waited for without holding the lock adding sets takes
+            self._join_checkpointer ()
+            
+            with self._lock:
+                self._sync ()
+                self._file.close ()
+                upto = self._gen + 1
+                self._open_segment (upto)
+                
+                thread = self._checkpointer = threading.Thread (target=self._checkpoint, args=(upto,))
+                thread.daemon = True
+                thread.start ()
+            
+            if wait:
+                self._join_checkpointer ()
+        
+        return thread
+    
+    def _checkpoint (self, upto):
+        try:
+            base, index = self._load_snapshot ()
+            segments = [gen for gen in self._segments () if base <= gen < upto]
+            index.add_many (item for gen in segments for item in _read_segment (self._segment_path (gen)))
+            
+            path = os.path.join (self._path, _SNAPSHOT)
+            with open (path + ".tmp", "wb") as f:
+                pickle.dump ((upto, index), f, _PROTOCOL)
+                f.flush ()
+                os.fsync (f.fileno ())
+            _replace (path + ".tmp", path)
+            
+            # the new snapshot has to be durable before the segments folded into it are removed
+            _fsync_dir (self._path)
+            
+            for gen in segments:
+                os.remove (self._segment_path (gen))
+            _fsync_dir (self._path)
+        except Exception as e:
+            self._checkpoint_error = e
+    
+    def _join_checkpointer (self):
+        thread = self._checkpointer
+        if thread is not None:
+            thread.join ()
+            self._checkpointer = None
+        
+        error = self._checkpoint_error
+        if error is not None:
+            self._checkpoint_error = None
+            raise error
+    
+    def close (self):
+        """
+        Write all journal records to disk, wait for a running checkpoint and close the journal.
+        """
+        
+        with self._lock:
+            if self._file is not None and not self._file.closed:
+                self._sync ()
+                self._file.close ()
+        
+        with self._checkpoint_lock:
+            self._join_checkpointer ()
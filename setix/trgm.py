@@ -1,12 +1,24 @@
-import re
-import six
-
 from . import SetIntersectionIndex, similarity
 
-__delim_pat = re.compile (r"[\W_]+", flags=re.UNICODE)
-__2s = six.u ("  ")
-__s = six.u (" ")
-__e = six.u ("")
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
+# joining these with unicode words gives unicode in python 2.x too
+__2s = "  "
+__s = " "
+__e = ""
+
+_delim_split = None
+
+def _split (phrase):
+    # the regex module is imported and the pattern compiled on first use, to keep importing this module cheap
+    global _delim_split
+    if _delim_split is None:
+        import re
+        _delim_split = re.compile (r"[\W_]+", flags=re.UNICODE).split
+    return _delim_split (phrase)
 
 def get_trigrams (phrase):
     """
@@ -25,14 +37,14 @@ def get_trigrams (phrase):
     
     phrase = phrase.lower ()
     grams = set()
-    for word in __delim_pat.split (phrase):
+    for word in _split (phrase):
         if word:
             word = __e.join ([__2s, word, __s])
             grams.update ([word[i:i+3] for i in range(len(word)-2)])
     return grams
 
-def phrase_similarity (phrase1, phrase2):
-    return similarity (get_trigrams (phrase1), get_trigrams (phrase2))
+def phrase_similarity (phrase1, phrase2, measure="jaccard"):
+    return similarity (get_trigrams (phrase1), get_trigrams (phrase2), measure)
 
 class TrigramIndex (object):
     """
@@ -92,6 +104,41 @@ class TrigramIndex (object):
         """
         return self.set_index.payloads
     
+    def get_payloads (self, sid):
+        """
+        Analogous to `SetIntersectionIndexBase.get_payloads`
+        """
+        
+        return self.set_index.get_payloads (sid)
+    
+    def memory_usage (self):
+        """
+        Analogous to `SetIntersectionIndexBase.memory_usage`
+        """
+        
+        return self.set_index.memory_usage ()
+    
+    def reserve (self, phrases=None, trigrams=None, postings=None):
+        """
+        Analogous to `SetIntersectionIndexBase.reserve`, with numbers of unique phrases and trigrams.
+        """
+        
+        return self.set_index.reserve (phrases, trigrams, postings)
+    
+    def register_filter (self, name, phrases):
+        """
+        Analogous to `SetIntersectionIndexBase.register_filter`, with ids of phrases as returned by `add`.
+        """
+        
+        return self.set_index.register_filter (name, phrases)
+    
+    def unregister_filter (self, name):
+        """
+        Analogous to `SetIntersectionIndexBase.unregister_filter`
+        """
+        
+        return self.set_index.unregister_filter (name)
+    
     def add (self, phrase, payload=_SENTINEL):
         """
         Analogous to `SetIntersectionIndexBase.add`
@@ -103,36 +150,66 @@ class TrigramIndex (object):
         if payload is self._SENTINEL:
             payload = phrase
         
-        if isinstance (phrase, six.string_types):
+        if isinstance (phrase, _string_types):
             data = get_trigrams (phrase)
         else:
             data = phrase
         
         return self.set_index.add (data, payload)
     
-    def find (self, phrase, threshold=1):
+    def find (self, phrase, threshold=1, filter=None, max_candidates=None, deadline=None):
         """
         Analogous to `SetIntersectionIndexBase.find`
         """
         
-        if isinstance (phrase, six.string_types):
+        if isinstance (phrase, _string_types):
             data = get_trigrams (phrase)
         else:
             data = phrase
         
-        return self.set_index.find (data, threshold)
+        return self.set_index.find (data, threshold, filter=filter, max_candidates=max_candidates, deadline=deadline)
     
-    def find_similar (self, phrase, threshold=0.3):
+    def find_similar (self, phrase, threshold=0.3, measure="jaccard", filter=None, max_candidates=None, deadline=None):
         """
         Analogous to `SetIntersectionIndexBase.find_similar`
         """
         
-        if isinstance (phrase, six.string_types):
+        if isinstance (phrase, _string_types):
             data = get_trigrams (phrase)
         else:
             data = phrase
         
-        return self.set_index.find_similar (data, threshold)
+        return self.set_index.find_similar (data, threshold, measure, filter, max_candidates, deadline)
+    
+    def find_many (self, phrases, threshold=1, filter=None):
+        """
+        Analogous to `SetIntersectionIndexBase.find_many`
+        """
+        
+        return self.set_index.find_many ([get_trigrams (phrase) if isinstance (phrase, _string_types) else phrase
+                                          for phrase in phrases],
+                                         threshold, filter)
+    
+    def find_similar_many (self, phrases, threshold=0.3, measure="jaccard", filter=None):
+        """
+        Analogous to `SetIntersectionIndexBase.find_similar_many`
+        """
+        
+        return self.set_index.find_similar_many ([get_trigrams (phrase) if isinstance (phrase, _string_types) else phrase
+                                                  for phrase in phrases],
+                                                 threshold, measure, filter)
+    
+    def similarity_join (self, threshold, other=None, measure="jaccard", chunk_size=2**20):
+        """
+        Analogous to `SetIntersectionIndexBase.similarity_join`, `other` can be another TrigramIndex.
+        
+        Set ids can be turned into phrases with the `get_payloads` method.
+        """
+        
+        if isinstance (other, TrigramIndex):
+            other = other.set_index
+        
+        return self.set_index.similarity_join (threshold, other, measure, chunk_size)
     
     def most_frequent (self, threshold=2.0/3.0, max_results=None, with_counts=False):
         """
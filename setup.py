@@ -26,6 +26,6 @@ setup(
         "Topic :: Text Processing :: Indexing",
         "Topic :: Scientific/Engineering :: Information Analysis",
         ],
-    install_requires = ["numpy>=1.5.0", "six"],
+    install_requires = ["numpy>=1.5.0", "six; python_version < '3'"],
     long_description = open(os.path.join(os.path.dirname(__file__), "README.rst"), "rb").read ()
 )
@@ -1,6 +1,12 @@
+import sys
 import unittest
 
 from .test_b_numpy import *
+from .test_b_minhash import *
 from .test_trgm import *
+if sys.version_info >= (3, 5):
+    from .test_aio import *
+from .test_journal import *
+from .test_import import *
 
 unittest.main ()
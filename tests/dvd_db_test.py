@@ -40,3 +40,6 @@ six.print_("CPU time used: {0:.1f}s".format (this.get_cpu_times().user))
 six.print_("Unique trigrams indexed: {0}".format (titles.trigram_count))
 six.print_("Unique phrases indexed: {0}".format (titles.phrase_count))
 six.print_("Memory used by index: {0:.1f}MB".format ((mem2.rss - mem1.rss) / 1024.0 / 1024.0))
+
+for component, size in sorted (titles.memory_usage ().items ()):
+    six.print_("  {0}: {1:.1f}MB".format (component, size / 1024.0 / 1024.0))
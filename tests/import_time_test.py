@@ -0,0 +1,26 @@
+"""
+Benchmark the cold start time of `import setix.trgm`, compared to a bare interpreter start.
+"""
+
+from __future__ import print_function
+
+import subprocess
+import sys
+import time
+
+def cold_start (code, repeat=20):
+    best = None
+    for i in range (repeat):
+        t = time.time ()
+        subprocess.check_call ([sys.executable, "-c", code])
+        t = time.time () - t
+        best = t if best is None else min (best, t)
+    return best
+
+bare = cold_start ("pass")
+trgm = cold_start ("import setix.trgm")
+loaded = cold_start ("import setix.trgm; setix.trgm.TrigramIndex ()")
+
+print ("Interpreter start: {0:.1f}ms".format (bare * 1000))
+print ("import setix.trgm: +{0:.1f}ms".format ((trgm - bare) * 1000))
+print ("first TrigramIndex (loads numpy): +{0:.1f}ms".format ((loaded - bare) * 1000))
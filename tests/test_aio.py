@@ -0,0 +1,85 @@
+import asyncio
+import unittest
+
+import setix.aio
+import setix.trgm
+
+class AioTests (unittest.TestCase):
+    def setUp (self):
+        ii = setix.trgm.TrigramIndex ()
+        ii.add ("adam mickiewicz")
+        ii.add ("adam mckiewicz")
+        ii.add ("adm mickiewicz")
+        ii.add ("juliusz slowacki")
+        
+        self.ii = ii
+        self.loop = asyncio.new_event_loop ()
+    
+    def tearDown (self):
+        self.loop.close ()
+    
+    def run_async (self, coro):
+        return self.loop.run_until_complete (coro)
+    
+    def test_basic (self):
+        aii = setix.aio.AsyncTrigramIndex (self.ii)
+        
+        desired = self.ii.find_similar ("adam mickiewicz", threshold=0.5).get_list ()
+        actual = self.run_async (aii.find_similar ("adam mickiewicz", threshold=0.5)).get_list ()
+        self.assertListEqual (actual, desired)
+        
+        desired = self.ii.find ("slowacki", threshold=3).get_list ()
+        actual = self.run_async (aii.find ("slowacki", threshold=3)).get_list ()
+        self.assertListEqual (actual, desired)
+        
+        self.assertEqual (aii.pending, 0)
+        aii.close ()
+    
+    def test_coalesce_and_batch (self):
+        aii = setix.aio.AsyncTrigramIndex (self.ii, batch=True)
+        queries = ["adam mickiewicz", "adam mickiewicz", "slowacki", "nothing like it"]
+        
+        async def run ():
+            return await asyncio.gather (*[aii.find_similar (q, threshold=0.3) for q in queries])
+        
+        results = self.run_async (run ())
+        
+        self.assertIs (results[0], results[1])
+        for q, r in zip (queries, results):
+            self.assertListEqual (r.get_list (), self.ii.find_similar (q, threshold=0.3).get_list ())
+        
+        self.assertEqual (aii.pending, 0)
+        aii.close ()
+    
+    def test_filtered_batch (self):
+        aii = setix.aio.AsyncTrigramIndex (self.ii, batch=True)
+        self.ii.register_filter ("adam", [0, 1])
+        queries = ["adam mickiewicz", "adm mickiewicz"]
+        
+        async def run (filter):
+            return await asyncio.gather (*[aii.find_similar (q, threshold=0.3, filter=filter) for q in queries])
+        
+        for filter in ("adam", [0, 1]):
+            for q, r in zip (queries, self.run_async (run (filter))):
+                self.assertListEqual (r.get_list (), self.ii.find_similar (q, threshold=0.3, filter="adam").get_list ())
+        
+        self.assertEqual (aii.pending, 0)
+        aii.close ()
+    
+    def test_queue_full_and_cancel (self):
+        aii = setix.aio.AsyncTrigramIndex (self.ii, max_pending=1)
+        
+        async def run ():
+            first = asyncio.ensure_future (aii.find ("adam"))
+            await asyncio.sleep (0)
+            with self.assertRaises (setix.aio.QueueFull):
+                await aii.find ("slowacki")
+            first.cancel ()
+            with self.assertRaises (asyncio.CancelledError):
+                await first
+            await asyncio.sleep (0)
+            return await aii.find ("slowacki")
+        
+        self.assertListEqual (self.run_async (run ()).get_list (), self.ii.find ("slowacki").get_list ())
+        self.assertEqual (aii.pending, 0)
+        aii.close ()
@@ -0,0 +1,116 @@
+import unittest
+
+import numpy
+
+import setix
+import setix.trgm
+
+PHRASES = ["adam mickiewicz", "adam mckiewicz", "adm mickiewicz", "adam mickiewizc",
+           "juliusz slowacki", "cyprian kamil norwid", "zygmunt krasinski"]
+
+class MinHashTests (unittest.TestCase):
+    def build (self, **kwargs):
+        ii = setix.trgm.TrigramIndex (setix.SetIntersectionIndex ("minhash", **kwargs))
+        exact = setix.trgm.TrigramIndex ()
+        for phrase in PHRASES:
+            ii.add (phrase)
+            exact.add (phrase)
+        return ii, exact
+    
+    def test_rescore (self):
+        ii, exact = self.build (bands=32, rows=1, rescore=True)
+        
+        for phrase in PHRASES:
+            desired = exact.find_similar (phrase, threshold=0.5).get_list ()
+            actual = ii.find_similar (phrase, threshold=0.5).get_list ()
+            self.assertListEqual (sorted (actual), sorted (desired))
+            
+            self.assertListEqual (sorted (ii.find (phrase, threshold=-2).get_list ()),
+                                  sorted (exact.find (phrase, threshold=-2).get_list ()))
+    
+    def test_filter (self):
+        ii, exact = self.build (bands=32, rows=1, rescore=True)
+        mask = numpy.array ([i % 2 == 0 for i in range (len (PHRASES))])
+        
+        for phrase in PHRASES:
+            desired = exact.find_similar (phrase, threshold=0.5, filter=mask).get_list ()
+            actual = ii.find_similar (phrase, threshold=0.5, filter=mask).get_list ()
+            self.assertListEqual (sorted (actual), sorted (desired))
+            self.assertTrue (all (PHRASES.index (payloads[0]) % 2 == 0 for score, payloads in actual))
+    
+    def test_limits (self):
+        import time
+        ii, exact = self.build (bands=32, rows=1, rescore=True)
+        
+        results = ii.find_similar (PHRASES[0], threshold=0.5, deadline=time.time () - 1)
+        self.assertTrue (results.partial)
+        self.assertEqual (len (results), 0)
+        
+        results = ii.find_similar (PHRASES[0], threshold=0.5, max_candidates=1)
+        self.assertTrue (results.partial)
+        self.assertLessEqual (len (results), 1)
+        
+        results = ii.find_similar (PHRASES[0], threshold=0.5, max_candidates=1000, deadline=time.time () + 100)
+        self.assertFalse (results.partial)
+        self.assertListEqual (sorted (results.get_list ()), sorted (exact.find_similar (PHRASES[0], threshold=0.5).get_list ()))
+    
+    def test_estimate (self):
+        ii, exact = self.build (bands=64, rows=2, rescore=False)
+        
+        actual = ii.find_similar ("adam mickiewicz", threshold=0.99).get_list ()
+        self.assertListEqual (actual, [(1.0, ["adam mickiewicz"])])
+        
+        actual = dict ((pls[0], score) for score, pls in ii.find_similar ("adam mickiewicz", threshold=0.3).get_list ())
+        for score, pls in exact.find_similar ("adam mickiewicz", threshold=0.5).get_list ():
+            self.assertAlmostEqual (actual[pls[0]], score, delta=0.2)
+    
+    def test_no_candidates (self):
+        ii, exact = self.build ()
+        
+        self.assertListEqual (ii.find_similar ("zzzzzz").get_list (), [])
+        self.assertListEqual (ii.find ("zzzzzz").get_list (), [])
+        self.assertListEqual (setix.SetIntersectionIndex ("minhash").find_similar ((1, 2)).get_list (), [])
+    
+    def test_most_frequent (self):
+        ii, exact = self.build ()
+        
+        self.assertListEqual (list (ii.most_frequent (with_counts=True)), list (exact.most_frequent (with_counts=True)))
+    
+    def test_query_size (self):
+        # repeated symbols count towards the query size and intersections like in the exact index
+        ix = setix.SetIntersectionIndex ("minhash", bands=32, rows=1, rescore=True)
+        exact = setix.SetIntersectionIndex ()
+        for s in ((1, 2, 3), (1, 1, 2, 3, 4)):
+            ix.add (s)
+            exact.add (s)
+        
+        self.assertListEqual (sorted (ix.find ((1, 1, 2, 3), threshold=-1).get_list ()),
+                              sorted (exact.find ((1, 1, 2, 3), threshold=-1).get_list ()))
+        self.assertListEqual (sorted (ix.find ((1, 1, 2, 3), threshold=4).get_list ()),
+                              sorted (exact.find ((1, 1, 2, 3), threshold=4).get_list ()))
+    
+    def test_add_many (self):
+        for rescore in (True, False):
+            one = setix.SetIntersectionIndex ("minhash", bands=8, rows=2, rescore=rescore)
+            many = setix.SetIntersectionIndex ("minhash", bands=8, rows=2, rescore=rescore)
+            sets = [(i % 7, 10 + i % 11, 30 + i % 13, 50 + i % 17) for i in range (3000)]
+            for s in sets:
+                one.add (s)
+            many.add_many ((s, s) for s in sets)
+            
+            self.assertEqual (one.set_count, many.set_count)
+            for s in sets[0:50]:
+                self.assertListEqual (sorted (one.find_similar (s, threshold=0.5).get_list ()),
+                                      sorted (many.find_similar (s, threshold=0.5).get_list ()))
+    
+    def test_memory_usage (self):
+        ix = setix.SetIntersectionIndex ("minhash")
+        exact = setix.SetIntersectionIndex ()
+        sets = [tuple (range (i % 1000, i % 1000 + 100)) for i in range (2000)]
+        ix.add_many ((s, i) for i, s in enumerate (sets))
+        exact.add_many ((s, i) for i, s in enumerate (sets))
+        
+        usage = ix.memory_usage ()
+        self.assertNotIn ("members", usage)
+        self.assertLess (usage["total"], exact.memory_usage ()["total"])
+        self.assertEqual (usage["total"], sum (v for k, v in usage.items () if k != "total"))
@@ -1,5 +1,7 @@
 import unittest
 
+import numpy
+
 import setix
 
 class NumpyTests (unittest.TestCase):
@@ -34,6 +36,69 @@ class NumpyTests (unittest.TestCase):
         self.assertTrue (set (ii.most_frequent(with_counts=True)) == set([(6,4), (5,3), (4,3), (3,3), (2,3), (1,3)]))
         self.assertTrue (set (ii.most_frequent(max_results=1)) == set([6]))
         
+    def test_measures (self):
+        ii = self.ii
+        query = set ((1, 2, 3))
+        sets = {(1, 2, 3, 4): (1, 2, 3, 4),
+                "foo": (1, 3, 5, 6),
+                (2, 4, 6, 7): (2, 4, 6, 7),
+                (2, 4, 5, 6): (2, 4, 5, 6)}
+        
+        for measure in setix.MEASURES:
+            for threshold in (0.1, 0.25, 0.5, 0.75, 1.0):
+                expected = dict ((key, setix.similarity (query, set (s), measure)) for key, s in sets.items ())
+                expected = dict ((key, score) for key, score in expected.items () if score >= threshold)
+                
+                actual = ii.find_similar (query, threshold=threshold, measure=measure).get_list ()
+                
+                self.assertEqual (len (actual), len (expected))
+                for score, pls in actual:
+                    self.assertAlmostEqual (score, expected[pls[0]])
+        
+        self.assertListEqual (ii.find_similar (query, threshold=1.0, measure="query_containment").get_list (),
+                              [(1.0, [(1, 2, 3, 4)])])
+        self.assertRaises (ValueError, ii.find_similar, query, measure="bogus")
+    
+    def test_many (self):
+        ii = self.ii
+        queries = [(1, 2, 3), (10,), (4, 6, 7), (1, 5, 6, 6)]
+        
+        for results, query in zip (ii.find_many (queries, threshold=1), queries):
+            self.assertListEqual (sorted (results.get_list (), key=repr), sorted (ii.find (query).get_list (), key=repr))
+        
+        for results, query in zip (ii.find_similar_many (queries, threshold=0.3, measure="dice"), queries):
+            self.assertListEqual (sorted (results.get_list (), key=repr), sorted (ii.find_similar (query, 0.3, "dice").get_list (), key=repr))
+    
+    def test_arrays_and_pages (self):
+        ii = setix.SetIntersectionIndex ("numpy")
+        for i in range (100):
+            self.assertEqual (ii.add (range (i % 50 + 1), i), i % 50)
+        self.assertListEqual (ii.get_payloads (3), [3, 53])
+        
+        results = ii.find (range (50))
+        desired = results.get_list ()
+        
+        sids, scores = results.arrays (10)
+        self.assertListEqual (list (sids), list (range (49, 39, -1)))
+        self.assertListEqual (list (scores), list (range (50, 40, -1)))
+        
+        results = ii.find (range (50))
+        self.assertEqual (len (results.arrays (0)[0]), 0)
+        self.assertListEqual (results.get_list (0), [])
+        self.assertListEqual (results.page (5, 0), [])
+        pages = [results.page (offset, 7) for offset in range (0, 56, 7)]
+        self.assertListEqual ([len (page) for page in pages], [7] * 7 + [1])
+        self.assertListEqual ([score for page in pages for score, pls in page], [score for score, pls in desired])
+        self.assertListEqual ([pls for page in pages for score, pls in page], [pls for score, pls in desired])
+        
+        self.assertEqual (len (ii.find ((1000,)).arrays ()[0]), 0)
+        for query in ((1000,), (1,)):
+            self.assertEqual (ii.find (query).arrays ()[0].dtype, ii._dtype_sets)
+            self.assertEqual (ii.find (query).arrays ()[1].dtype, numpy.intp)
+            self.assertEqual (ii.find_similar (query, 0.01).arrays ()[0].dtype, ii._dtype_sets)
+            self.assertEqual (ii.find_similar (query, 0.01).arrays ()[1].dtype, numpy.float64)
+        self.assertListEqual (ii.find ((1000,)).page (0, 10), [])
+    
     def test_resultless_find (self):
         ii = self.ii
         
@@ -63,3 +128,138 @@ class NumpyTests (unittest.TestCase):
         
         self.assertListEqual (list (ii.most_frequent ()), [])
         self.assertListEqual (list (ii.most_frequent (with_counts=True)), [])
+    
+    def test_memory_usage (self):
+        usage = self.ii.memory_usage ()
+        
+        self.assertEqual (usage["postings_used"], 16 * self.ii._dtype_sets ().itemsize)
+        self.assertEqual (usage["total"], sum (size for component, size in usage.items () if component != "total"))
+        self.assertTrue (all (size >= 0 for size in usage.values ()))
+    
+    def test_reserve (self):
+        ii = setix.SetIntersectionIndex ("numpy", growth_factor=2)
+        ii.reserve (sets=1000, symbols=500, postings={1: 300, 2: 10})
+        ii.add ((1, 2))
+        ii.reserve (postings=20)
+        
+        usage = ii.memory_usage ()
+        self.assertEqual (usage["postings_used"] + usage["postings_slack"], (300 + 20) * ii._dtype_sets ().itemsize)
+        
+        sets = ii._sets
+        for i in range (999):
+            ii.add ((1, 3, i + 10))
+        self.assertIs (ii._sets, sets)
+        self.assertEqual (ii.find ((1, 3)).get_list (1)[0][0], 2)
+        self.assertEqual (len (list (ii.most_frequent (threshold=0))), ii.symbol_count)
+        self.assertEqual (dict (ii.most_frequent (max_results=3, with_counts=True))[1], 1000)
+        
+        # a number of postings doesn't apply to symbols added later
+        ii.add ((4,))
+        self.assertEqual (ii._index[4][2].size, ii._init_bs)
+    
+    def test_filter (self):
+        ii = self.ii
+        ii.register_filter ("even", [0, 2])
+        ii.register_filter ("first", numpy.array ([True, True]))
+        
+        self.assertListEqual (ii.find ((1, 2, 3), threshold=2, filter="even").get_list (), [(3, [(1, 2, 3, 4)])])
+        self.assertListEqual (ii.find ((1, 2, 3), filter=[1, 3]).get_list (), [(2, ["foo", "bar"]), (1, [(2, 4, 5, 6)])])
+        self.assertListEqual (ii.find_similar ((2, 4, 6), filter="first").get_list (), [(0.4, [(1, 2, 3, 4)])])
+        self.assertEqual (len (ii.find_similar ((5, 7), filter=numpy.zeros (4, dtype=bool))), 0)
+        self.assertListEqual (ii.find ((2, 4), threshold=2, filter=[False, False, True]).get_list (), [(2, [(2, 4, 6, 7)])])
+        self.assertEqual (len (ii.find ((2, 4), filter=[])), 0)
+        
+        # sets added after registering a filter don't pass it
+        sid = ii.add ((1, 2, 3))
+        self.assertListEqual (ii.find ((1, 2, 3), threshold=3, filter="even").get_list (), [(3, [(1, 2, 3, 4)])])
+        
+        results = ii.find_many ([(1, 2), (6, 7)], filter=[sid, 2])
+        self.assertListEqual ([r.get_list () for r in results], [[(2, [(1, 2, 3)]), (1, [(2, 4, 6, 7)])], [(2, [(2, 4, 6, 7)])]])
+        self.assertEqual (len (ii.find_similar_many ([(1, 2)], threshold=0.2, filter="first")[0]), 2)
+        
+        self.assertRaises (ValueError, ii.find, (1, 2), filter="missing")
+        self.assertRaises (ValueError, ii.register_filter, "bad", [ii.set_count])
+        ii.unregister_filter ("even")
+        self.assertRaises (ValueError, ii.find, (1, 2), filter="even")
+    
+    def test_limits (self):
+        import time
+        from setix.backends import b_numpy
+        
+        ii = self.ii
+        query = (1, 2, 5, 6, 7)
+        desired = ii.find (query).get_list ()
+        
+        results = ii.find (query, max_candidates=100, deadline=time.time () + 100)
+        self.assertFalse (results.partial)
+        self.assertListEqual (results.get_list (), desired)
+        
+        # the rarest symbol (7) comes first
+        results = ii.find (query, max_candidates=1)
+        self.assertTrue (results.partial)
+        self.assertAlmostEqual (results.processed, 1 / 11.0)
+        self.assertListEqual (results.get_list (), [(1, [(2, 4, 6, 7)])])
+        
+        results = ii.find_similar (query, threshold=0.1, deadline=time.time () - 1)
+        self.assertTrue (results.partial)
+        self.assertEqual (results.processed, 0)
+        self.assertEqual (len (results), 0)
+        
+        # counting in chunks
+        chunk = b_numpy._CHUNK
+        b_numpy._CHUNK = 2
+        try:
+            results = ii.find_similar (query, threshold=0.1, deadline=time.time () + 100, filter=[0, 1, 3])
+        finally:
+            b_numpy._CHUNK = chunk
+        self.assertFalse (results.partial)
+        self.assertListEqual (results.get_list (), ii.find_similar (query, threshold=0.1, filter=[0, 1, 3]).get_list ())
+        
+        self.assertFalse (setix.EmptySearchResults ().partial)
+        self.assertRaises (ValueError, ii.find, query, max_candidates=0)
+    
+    def test_similarity_join (self):
+        import random
+        
+        rnd = random.Random (1)
+        sets = [tuple (rnd.sample (range (30), rnd.randint (1, 8))) for i in range (300)]
+        sets += [s + (s[0],) for s in sets[0:20]]  # repeated symbols
+        other_sets = [tuple (rnd.sample (range (10, 40), rnd.randint (1, 8))) for i in range (200)]
+        
+        ii = setix.SetIntersectionIndex ("numpy")
+        jj = setix.SetIntersectionIndex ("numpy")
+        for s in sets:
+            ii.add (s)
+        for s in other_sets:
+            jj.add (s)
+        
+        for measure in ("jaccard", "dice", "cosine"):
+            for threshold in (0.3, 0.6, 1.0):
+                # self join
+                expected = {}
+                for x in range (ii.set_count):
+                    for y in range (x + 1, ii.set_count):
+                        score = setix.similarity (set (ii.get_payloads (x)[0]), set (ii.get_payloads (y)[0]), measure)
+                        if score >= threshold:
+                            expected[(x, y)] = score
+                
+                actual = {}
+                for a, b, scores in ii.similarity_join (threshold, measure=measure, chunk_size=50):
+                    for pair in zip (a, b, scores):
+                        self.assertNotIn (pair[0:2], actual)
+                        actual[pair[0:2]] = pair[2]
+                
+                self.assertEqual (sorted (actual), sorted (expected))
+                for pair, score in expected.items ():
+                    self.assertAlmostEqual (actual[pair], score)
+                
+                # join with another index
+                expected = set ((x, y) for x in range (ii.set_count) for y in range (jj.set_count)
+                                if setix.similarity (set (ii.get_payloads (x)[0]), set (jj.get_payloads (y)[0]), measure) >= threshold)
+                actual = set ((a, b) for aa, bb, scores in ii.similarity_join (threshold, jj, measure) for a, b in zip (aa, bb))
+                self.assertEqual (actual, expected)
+        
+        self.assertRaises (ValueError, ii.similarity_join, 0.5, measure="overlap")
+        self.assertRaises (TypeError, ii.similarity_join, 0.5, object ())
+        self.assertRaises (NotImplementedError, setix.SetIntersectionIndex ("minhash").similarity_join, 0.5)
+        self.assertListEqual (list (setix.SetIntersectionIndex ("numpy").similarity_join (0.5)), [])
@@ -0,0 +1,20 @@
+import subprocess
+import sys
+import unittest
+
+def _loaded (statement, modules):
+    code = "import sys; {0}; print (' '.join (m for m in {1!r} if m in sys.modules))".format (statement, modules)
+    return subprocess.check_output ([sys.executable, "-c", code]).decode ().split ()
+
+def loaded_after (statement, modules):
+    # modules imported by the interpreter's startup (site hooks, sitecustomize) don't count
+    baseline = set (_loaded ("pass", modules))
+    return [m for m in _loaded (statement, modules) if m not in baseline]
+
+class ImportTests (unittest.TestCase):
+    def test_lazy_import (self):
+        self.assertListEqual (loaded_after ("import setix.trgm", ("numpy", "six", "re", "setix.backends.b_numpy")), [])
+    
+    def test_backend_loaded_on_use (self):
+        self.assertListEqual (loaded_after ("import setix.trgm; setix.trgm.TrigramIndex ()", ("numpy", "setix.backends.b_numpy")),
+                              ["numpy", "setix.backends.b_numpy"])
@@ -0,0 +1,154 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import setix.journal
+import setix.trgm
+
+class JournalTests (unittest.TestCase):
+    def setUp (self):
+        self.path = tempfile.mkdtemp ()
+    
+    def tearDown (self):
+        shutil.rmtree (self.path)
+    
+    def fill (self, ii):
+        ii.add ((1, 2, 3, 4))
+        ii.add ((1, 3, 5, 6), "foo")
+        ii.add_many ([((1, 3, 5, 6), "bar"), ((2, 4, 6, 7), {"x": 1})])
+    
+    def assertSameIndex (self, ii, jj):
+        self.assertEqual (ii.set_count, jj.set_count)
+        self.assertEqual (ii.symbol_count, jj.symbol_count)
+        self.assertEqual (list (ii.payloads), list (jj.payloads))
+        for query in ((1, 2, 3), (6,), (7, 8)):
+            self.assertListEqual (ii.find (query).get_list (), jj.find (query).get_list ())
+            self.assertListEqual (ii.find_similar (query, 0.1).get_list (), jj.find_similar (query, 0.1).get_list ())
+    
+    def test_replay (self):
+        ii = setix.journal.JournaledIndex (self.path)
+        self.fill (ii)
+        ii.close ()
+        
+        jj = setix.journal.JournaledIndex (self.path)
+        self.assertSameIndex (ii, jj)
+        self.assertListEqual (list (jj.payloads), [(1, 2, 3, 4), "foo", "bar", {"x": 1}])
+        jj.close ()
+    
+    def test_torn_tail (self):
+        ii = setix.journal.JournaledIndex (self.path, sync_every=1)
+        self.fill (ii)
+        ii.close ()
+        
+        segment = os.path.join (self.path, sorted (os.listdir (self.path))[-1])
+        with open (segment, "r+b") as f:
+            f.truncate (os.path.getsize (segment) - 3)
+        
+        jj = setix.journal.JournaledIndex (self.path)
+        self.assertEqual (jj.set_count, 2)
+        self.assertListEqual (list (jj.payloads), [(1, 2, 3, 4), "foo", "bar"])
+        jj.close ()
+    
+    def test_checkpoint (self):
+        ii = setix.journal.JournaledIndex (self.path)
+        self.fill (ii)
+        ii.checkpoint (wait=True)
+        ii.add ((2, 4, 5, 6))
+        ii.close ()
+        
+        self.assertListEqual (sorted (os.listdir (self.path)), ["journal.00000002", "snapshot"])
+        
+        jj = setix.journal.JournaledIndex (self.path)
+        self.assertSameIndex (ii, jj)
+        jj.close ()
+    
+    def test_unpicklable_payload (self):
+        import threading
+        
+        ii = setix.journal.JournaledIndex (self.path)
+        ii.add (("a", "b"))
+        self.assertRaises (Exception, ii.add, ("c", "d"), threading.Lock ())
+        self.assertRaises (Exception, ii.add_many, [(("e",), "e"), (("f",), threading.Lock ())])
+        ii.add (("c", "d", "e"), "x")
+        ii.close ()
+        
+        self.assertEqual (ii.set_count, 2)
+        
+        jj = setix.journal.JournaledIndex (self.path)
+        self.assertSameIndex (ii, jj)
+        self.assertListEqual (list (jj.payloads), [("a", "b"), "x"])
+        jj.close ()
+    
+    def test_index_full (self):
+        ii = setix.journal.JournaledIndex (self.path, max_sets=200)
+        self.assertRaises (RuntimeError, ii.add_many, [((i, i + 1000), i) for i in range (300)])
+        self.assertRaises (RuntimeError, ii.add, (1, 2))
+        count = ii.set_count
+        ii.close ()
+        
+        # symbols of the set which didn't fit may stay in the live index, but every set added is journaled
+        jj = setix.journal.JournaledIndex (self.path, max_sets=200)
+        self.assertEqual (jj.set_count, count)
+        self.assertEqual (list (jj.payloads), list (ii.payloads))
+        self.assertListEqual (jj.find ((5, 1005)).get_list (), ii.find ((5, 1005)).get_list ())
+        jj.close ()
+    
+    def test_checkpoint_doesnt_block_adds (self):
+        import threading
+        
+        ii = setix.journal.JournaledIndex (self.path)
+        self.fill (ii)
+        
+        release = threading.Event ()
+        checkpoint = ii._checkpoint
+        ii._checkpoint = lambda upto: (release.wait (10), checkpoint (upto))
+        ii.checkpoint ()
+        
+        second = threading.Thread (target=ii.checkpoint)
+        second.start ()
+        second.join (0.1)
+        
+        # the second checkpoint waits for the first one, adding sets doesn't
+        ii.add ((2, 4, 5, 6))
+        self.assertTrue (second.is_alive ())
+        
+        release.set ()
+        second.join ()
+        ii.close ()
+        
+        jj = setix.journal.JournaledIndex (self.path)
+        self.assertSameIndex (ii, jj)
+        jj.close ()
+    
+    def test_directory_sync (self):
+        events = []
+        fsync_dir = setix.journal._fsync_dir
+        replace = setix.journal._replace
+        remove = os.remove
+        setix.journal._fsync_dir = lambda path: events.append ("fsync")
+        setix.journal._replace = lambda src, dst: (events.append ("replace"), replace (src, dst))
+        os.remove = lambda path: (events.append ("remove"), remove (path))
+        try:
+            ii = setix.journal.JournaledIndex (self.path)
+            self.fill (ii)
+            ii.checkpoint (wait=True)
+            ii.close ()
+        finally:
+            setix.journal._fsync_dir = fsync_dir
+            setix.journal._replace = replace
+            os.remove = remove
+        
+        # new segments, the new snapshot, and removals of folded segments
+        self.assertListEqual (events, ["fsync", "fsync", "replace", "fsync", "remove", "fsync"])
+    
+    def test_trigram_index (self):
+        ii = setix.trgm.TrigramIndex (setix.journal.JournaledIndex (self.path))
+        ii.add ("adam mickiewicz")
+        ii.add ("adam mckiewicz", 2)
+        ii.set_index.close ()
+        
+        jj = setix.trgm.TrigramIndex (setix.journal.JournaledIndex (self.path))
+        self.assertListEqual (jj.find_similar ("adam mickiewicz").get_list (),
+                              ii.find_similar ("adam mickiewicz").get_list ())
+        jj.set_index.close ()